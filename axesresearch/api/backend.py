@@ -9,10 +9,20 @@ import hashlib
 import utils
 import logging
 import time
+import uuid
+import threading
+import functools
+import inspect
 
 from postprocess import RegexPostprocessor
+from cache import GenerationWatcher, LRUCache, SingleFlight, spawn
+from cache import copy_document, document_size
+from metrics import CacheMetrics, RpcStats
+from rpc import ConnectionPool, FanOut, RpcBatch, TimedServer, make_transport
 from django.conf import settings
 from query import encode_query
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timedelta
 
 log = logging.getLogger('axesresearch')
 
@@ -29,19 +39,63 @@ class LimasService(object):
     Service wrapper around the LIMAS JSON RPC API
     """
     
+    # Default options for the different types of request
+    lookup_options = dict(spokenWords=True, metadata=True, entityOccurrences=True)
+    search_options = dict(spokenWords=True, metadata=True, limit=200)
+    suggest_options = dict(spokenWords=False, metadata=True)
+    related_options = dict(metadata=True, limit=10)
+    
+    # Per method timings of the RPC calls made by this process
+    rpc_stats = RpcStats(settings.LIMAS_RPC_STATS_WINDOW, 
+        settings.LIMAS_SLOW_CALL_THRESHOLD, settings.LIMAS_SLOW_CALL_HISTORY)
+    
+    # Keep-alive connections to limas shared by all instances in the process
+    if settings.LIMAS_CONNECTION_POOL_ENABLED:
+        connection_pool = ConnectionPool(
+            settings.LIMAS_CONNECTION_POOL_SIZE, 
+            settings.LIMAS_CONNECTION_POOL_IDLE_TIMEOUT,
+            settings.LIMAS_CONNECTION_TIMEOUT)
+    else:
+        connection_pool = None
+        
+    # Runs independent RPCs concurrently
+    fan_out = FanOut(settings.LIMAS_FAN_OUT, settings.LIMAS_FAN_OUT_THREADS,
+        settings.LIMAS_FAN_OUT_TIMEOUT)
+        
+    # Whether to send JSON-RPC batches (turned off if limas rejects one)
+    batches_enabled = settings.LIMAS_RPC_BATCHES
+    
     def __init__(self):
-        self._service = None
-        self._service_type = jsonrpclib.Server
+        self._local = threading.local()
+        self._service_type = self._connect
         self._postprocessors = [
             RegexPostprocessor(settings.LIMAS_RESPONSE_POSTPROCESSING_RULES)
         ]
         
+    def _connect(self, url):
+        if settings.LIMAS_RPC_STATS_ENABLED:
+            return TimedServer(url, self.rpc_stats, self.connection_pool)
+        transport = make_transport(url, self.connection_pool)
+        return jsonrpclib.Server(url, transport=transport)
+        
     @property
     def service(self):
-        # Lazy connection creation
-        if self._service is None:
-            self._service = self._service_type(settings.SERVICE_URL)
-        return self._service
+        # Lazy connection creation, one proxy per thread (or greenlet) since
+        # calls may be fanned out
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._service_type(settings.SERVICE_URL)
+            self._local.service = service
+        return service
+    
+    def batch(self):
+        """
+        Returns a context that sends the RPCs made on it as one JSON-RPC
+        batch request on exit (see rpc.RpcBatch)
+        """
+        def on_rejected():
+            LimasService.batches_enabled = False
+        return RpcBatch(self.service, on_rejected)
     
     @staticmethod    
     def fix_uri(uri):
@@ -53,6 +107,12 @@ class LimasService(object):
             uri = '/' + uri
         return uri
         
+    @staticmethod
+    def make_options(defaults, kwargs):
+        options = dict(defaults)
+        options.update(kwargs)
+        return options
+        
     @staticmethod
     def to_limas_query_id(id):
         return 'urn:query:{}'.format(id)
@@ -86,72 +146,134 @@ class LimasService(object):
             response = postprocessor.process(response)
         return response
     
-    def lookup_video(self, uri, **kwargs):
-        uri = self.fix_uri(uri)
-        options = dict(spokenWords=True, metadata=True, entityOccurrences=True)
-        options.update(kwargs)
+    def _lookup(self, uris, **kwargs):
+        """
+        Issue a single lookup() RPC for a list of (fixed) URIs. Returns the 
+        raw results aligned with uris, padded with None.
+        """
+        options = self.make_options(self.lookup_options, kwargs)
         
         try:
-            result = self.service.lookup([uri], options)
+            result = self.service.lookup(uris, options)
         except jsonrpclib.ProtocolError, e:
             raise LimasError('lookup() error', e, 
-                uri=uri, options=options)
+                uris=uris, options=options)
         
-        if len(result) == 0:
-            return None
-        video = result[0]
-        if video is None:
+        result = list(result or [])
+        return result + [None] * (len(uris) - len(result))
+        
+    @staticmethod
+    def _as_video(uri, item):
+        if item is None:
             return None
-        if video['videoUri'] != uri:
-            if video['videoUri'] is None:
-                video['videoUri'] = uri
+        if item['videoUri'] != uri:
+            if item['videoUri'] is None:
+                item['videoUri'] = uri
             else:
                 return None
-        return self.postprocess(video)
+        return item
         
-    def lookup_segment(self, uri, **kwargs):
+    @staticmethod
+    def _as_segment(uri, item):
+        if item is None:
+            return None
+        if item['videoUri'] == uri or item['videoUri'] is None:
+            # Result is a video and not a segment
+            return None
+        return item
+    
+    def lookup_video(self, uri, **kwargs):
         uri = self.fix_uri(uri)
-        options = dict(spokenWords=True, metadata=True, entityOccurrences=True)
-        options.update(kwargs)
+        video = self._as_video(uri, self._lookup([uri], **kwargs)[0])
+        if video is None:
+            return None
+        return self.postprocess(video)
         
-        try:
-            result = self.service.lookup([uri], options)
-        except jsonrpclib.ProtocolError, e:
-            raise LimasError('lookup() error', e, 
-                uri=uri, options=options) 
+    def lookup_videos(self, uris, **kwargs):
+        """
+        Lookup several videos using a single lookup() RPC. Returns a list
+        aligned with uris containing None for any URI that is not a video.
+        """
+        uris = map(self.fix_uri, uris)
+        if not uris:
+            return []
+        videos = []
+        for uri, item in zip(uris, self._lookup(uris, **kwargs)):
+            video = self._as_video(uri, item)
+            if video is not None:
+                video = self.postprocess(video)
+            videos.append(video)
+        return videos
         
-        if len(result) == 0:
-            return None
-        segment = result[0]
+    def lookup_segment(self, uri, **kwargs):
+        uri = self.fix_uri(uri)
+        segment = self._as_segment(uri, self._lookup([uri], **kwargs)[0])
         if segment is None:
             return None
-        if segment['videoUri'] == uri or segment['videoUri'] is None:
-            # Result is a video and not a segment
-            return None
         return self.postprocess(segment)
         
+    def lookup_segments(self, uris, **kwargs):
+        """
+        Lookup several segments using a single lookup() RPC. Returns a list
+        aligned with uris containing None for any URI that is not a segment.
+        """
+        uris = map(self.fix_uri, uris)
+        if not uris:
+            return []
+        segments = []
+        for uri, item in zip(uris, self._lookup(uris, **kwargs)):
+            segment = self._as_segment(uri, item)
+            if segment is not None:
+                segment = self.postprocess(segment)
+            segments.append(segment)
+        return segments
+        
     def get_available_services(self):
         return map(str, self.service.getAvailableServices())
     
     def lookup_asset(self, uri, **kwargs):
-        uri = self.fix_uri(uri)
-        segment = self.lookup_segment(uri, **kwargs)
-        if segment is None:
-            asset_type = 'Video'
-            video = self.lookup_video(uri, **kwargs)
-        else:
-            asset_type = 'Segment'
-            video = self.lookup_video(segment['videoUri'], **kwargs)
-        asset = {
-            'uri': uri,
-            'type': asset_type,
-            'video': video,
-            'segment': segment }
-        return self.postprocess(asset)
+        # One RPC for a video, and a second for the parent of a segment
+        return self.lookup_assets([uri], **kwargs)[0]
+    
+    def lookup_assets(self, uris, **kwargs):
+        """
+        Lookup several assets using one lookup() RPC for the URIs themselves
+        and one lookup_videos() call for the parent videos of any segments. 
+        Returns a list of assets aligned with uris containing None for any
+        unknown URI.
+        """
+        uris = map(self.fix_uri, uris)
+        if not uris:
+            return []
+        items = self._lookup(uris, **kwargs)
+        segments = [self._as_segment(uri, item) 
+            for uri, item in zip(uris, items)]
+        parent_uris = list(set(segment['videoUri'] 
+            for segment in segments if segment is not None))
+        parents = dict(zip(parent_uris, 
+            self.lookup_videos(parent_uris, **kwargs)))
+        assets = []
+        for uri, item, segment in zip(uris, items, segments):
+            if segment is None:
+                asset_type = 'Video'
+                video = self._as_video(uri, item)
+                if video is None:
+                    assets.append(None)
+                    continue
+                video = self.postprocess(video)
+            else:
+                asset_type = 'Segment'
+                segment = self.postprocess(segment)
+                video = parents[segment['videoUri']]
+            assets.append({
+                'uri': uri,
+                'type': asset_type,
+                'video': video,
+                'segment': segment })
+        return assets
     
     def search(self, query, **kwargs):
-        options = dict(spokenWords=True, metadata=True, limit=200)
-        options.update(kwargs)
+        options = self.make_options(self.search_options, kwargs)
         query_object = self.make_query_object(query, options)
         try:
             results = self.service.search(query_object)
@@ -159,10 +281,59 @@ class LimasService(object):
             raise LimasError('search() error', e, query=query_object)
         results['queryId'] = str(query['_id'])
         return self.postprocess(results)
+        
+    def search_page(self, query, first=0, count=50, **kwargs):
+        """
+        Search, returning only the ranking entries from first to first + 
+        count, and the videos and segments they refer to. The ranking is 
+        fetched to the default search limit, or further in steps of that
+        size for pages past it.
+        """
+        step = kwargs.pop('limit', self.search_options['limit'])
+        depth = self.page_depth(first, count, step)
+        results = self.search(query, limit=depth, **kwargs)
+        if results is None:
+            return None
+        return self.make_page(results, first, count, depth)
+        
+    @staticmethod
+    def page_depth(first, count, step):
+        # Smallest multiple of step that reaches the end of the page, up to
+        # the maximum search depth
+        depth = max(1, (first + count + step - 1) // step) * step
+        return min(depth, max(step, settings.LIMAS_SEARCH_MAX_DEPTH))
+        
+    @staticmethod
+    def make_page(results, first, count, depth):
+        """
+        Extract a page from search results fetched with a limit of depth. 
+        The page records the total number of results fetched, and whether 
+        that is all of them (complete).
+        """
+        embedded = ('ranking', 'videos', 'segments')
+        page = dict((k, v) for k, v in results.iteritems() 
+            if k not in embedded)
+        ranking = results.get('ranking', [])
+        videos = results.get('videos', {})
+        segments = results.get('segments', {})
+        page['ranking'] = ranking[first:first + count]
+        page['videos'] = {}
+        page['segments'] = {}
+        for item in page['ranking']:
+            uri = item.get('uri')
+            if uri in segments:
+                page['segments'][uri] = segments[uri]
+                uri = segments[uri].get('videoUri')
+            if uri in videos:
+                page['videos'][uri] = videos[uri]
+        page['first'] = first
+        page['count'] = len(page['ranking'])
+        page['total'] = len(ranking)
+        page['complete'] = len(ranking) < depth
+        return page
     
     def suggest(self, query, **kwargs):
-        options = dict(spokenWords=False, metadata=True)
-        options.update(kwargs)
+        options = self.make_options(self.suggest_options, kwargs)
         query_object = self.make_query_object(query, options)
         try:
             entity_scores = self.service.suggestEntities(query_object)
@@ -175,8 +346,7 @@ class LimasService(object):
     
     def find_related_videos(self, uri, **kwargs):
         uri = self.fix_uri(uri)
-        options = dict(metadata=True, limit=10)
-        options.update(kwargs)
+        options = self.make_options(self.related_options, kwargs)
         try:
             videos = self.service.findRelatedVideos(uri, options)
         except jsonrpclib.ProtocolError, e:
@@ -190,8 +360,7 @@ class LimasService(object):
     
     def find_related_segments(self, uri, **kwargs):
         uri = self.fix_uri(uri)
-        options = dict(metadata=True, limit=10)
-        options.update(kwargs)
+        options = self.make_options(self.related_options, kwargs)
         try:
             segments = self.service.findRelatedSegments(uri, options)
         except jsonrpclib.ProtocolError, e:
@@ -232,14 +401,26 @@ class LimasService(object):
         return response 
     
     def get_collection_statistics(self):
-        stats = {}
-        for k, v in settings.LIMAS_STATS.iteritems():
+        def lookup_stat(k, v, call=None):
             try:
-                stat = self.service.lookupStat(k, v)
+                if call is not None:
+                    return call.result
+                return self.service.lookupStat(k, v)
             except jsonrpclib.ProtocolError, e:
                 raise LimasError('lookupStat() error', e, name=k, limit=v)
-            stats[k] = stat
-        response = {'stats': stats}
+        limits = settings.LIMAS_STATS.items()
+        if self.batches_enabled:
+            # One request for all of the statistics
+            with self.batch() as batch:
+                calls = [batch.lookupStat(k, v) for k, v in limits]
+            stats = [lookup_stat(k, v, call) 
+                for (k, v), call in zip(limits, calls)]
+        else:
+            # Concurrent requests for each statistic
+            stats = self.fan_out.map(functools.partial(lookup_stat, k, v) 
+                for k, v in limits)
+        response = {'stats': dict((k, stat) 
+            for (k, v), stat in zip(limits, stats))}
         return self.postprocess(response)
     
     def submit_feedback(self, query_id, value, **kwargs):
@@ -278,6 +459,18 @@ class LimasService(object):
         return self.postprocess(response)
         
 MONGO_ID = '_id'
+
+# Field recording the options a cached document was fetched with
+OPTIONS = '_options'
+
+# Field recording the cache generation a cached document was fetched under
+GENERATION = '_generation'
+
+# Field recording (approximately) when a cached document was last used
+LAST_ACCESS = '_lastAccess'
+
+# Field marking an entry of the segments cache for a URI that is a video
+NOT_SEGMENT = '_notSegment'
         
 class CachedLimasService(LimasService):
     """
@@ -290,7 +483,6 @@ class CachedLimasService(LimasService):
     caches = (
         'videos', 
         'segments', 
-        'assets', 
         'relatedvideos', 
         'relatedsegments',
         'keyframes', 
@@ -300,124 +492,920 @@ class CachedLimasService(LimasService):
         'suggestions', 
         'results')
     
+    # Options that limit the length of the ranking in a response
+    sliced_options = ('limit',)
+    
+    # Response fields that are only present when an option is enabled
+    option_fields = {
+        'spokenWords': 'spokenWords',
+        'entityOccurrences': 'entityOccurrences',
+        'metadata': 'metadata'}
+    
+    # Generation of the limas index, shared by all instances in the process
+    watcher = GenerationWatcher(
+        lambda: LimasService().get_last_update_time(),
+        settings.LIMAS_GENERATION_POLL_INTERVAL,
+        errors=(LimasError, IOError, OSError))
+    
+    # Time each cache was last cleared, shared by all instances in the process
+    cache_ages = GenerationWatcher(
+        lambda: dict((info[MONGO_ID], info['age']) 
+            for info in CachedLimasService.db.cacheinfo.find(
+                {'age': {'$exists': True}})),
+        settings.LIMAS_GENERATION_POLL_INTERVAL)
+    
+    # Hit/miss counters and timings, aggregated over processes in mongodb
+    metrics = CacheMetrics(db.cachemetrics, 
+        settings.LIMAS_CACHE_METRICS_FLUSH_INTERVAL)
+    
+    # Documents from search results still being written to the segments 
+    # and videos caches in the background, keyed by (cache, id)
+    pending_writes = {}
+    pending_lock = threading.Lock()
+    
+    # Cache fills in progress in this process
+    inflight = SingleFlight()
+    
+    # Stale entries being refreshed in the background by this process
+    refreshing = set()
+    refreshing_lock = threading.Lock()
+    
+    # Optional in-process cache in front of the mongodb caches
+    if settings.LIMAS_LOCAL_CACHE_ENABLED:
+        local_cache = LRUCache(
+            settings.LIMAS_LOCAL_CACHE_MAX_ENTRIES, 
+            settings.LIMAS_LOCAL_CACHE_MAX_BYTES)
+    else:
+        local_cache = None
+    
     def on_cache_hit(self, dbname, key):
-        pass
+        self.metrics.increment(dbname, 'hits')
         
     def on_cache_miss(self, dbname, key):
-        pass
+        self.metrics.increment(dbname, 'misses')
+        
+    def on_cache_stale(self, dbname, key):
+        self.metrics.increment(dbname, 'stale')
+        
+    def on_cache_read(self, dbname, seconds):
+        self.metrics.timing(dbname, 'read', seconds)
+        
+    def on_cache_fill(self, dbname, seconds, objects):
+        self.metrics.timing(dbname, 'fill', seconds)
+        for object in objects:
+            self.metrics.size(dbname, document_size(object))
         
     def clear_caches(self, caches=None):
+        """
+        Invalidate caches by starting a new generation for them. Existing 
+        entries are outdated immediately and removed later by sweep_caches.
+        """
         if caches is None:
             caches = self.caches
+        timestamp = time.time()
         for cache in caches:
-            # Remove cache
-            self.db[cache].remove()
             # Update cache age timestamp
-            timestamp = time.time()
             self.db.cacheinfo.update({MONGO_ID: cache}, 
                 { '$set': {'age': timestamp} }, upsert=True)
+        self.cache_ages.invalidate()
+        if self.local_cache is not None:
+            self.local_cache.clear()
         return caches
         
-    def cache_is_invalid(self, cache):
-        try:
-            last_modified = self.get_last_update_time()
-        except LimasError, e:
-            # If there is a limas error, assume caches are good. This allows
-            # us to pull data from the cache when limas is down
-            log.error(e)
-            return False
+    def sweep_caches(self, caches=None):
+        """
+        Remove outdated entries from the caches. Returns a dictionary mapping
+        cache names to the number of entries removed.
+        """
+        if caches is None:
+            caches = self.caches
+        removed = {}
+        for cache in caches:
+            generation = self.cache_generation(cache)
+            if generation is None:
+                continue
+            if self._can_serve_stale(cache):
+                # Outdated entries may still be served, but not entries from 
+                # before the cache was cleared
+                generation = self.cache_cleared(cache)
+                if not generation:
+                    continue
+            self.db[cache].ensure_index(GENERATION)
+            result = self.db[cache].remove({'$or': [
+                {GENERATION: {'$lt': generation}}, 
+                {GENERATION: None}]})
+            removed[cache] = result.get('n', 0) if result else 0
+        return removed
+    
+    def evict_caches(self, caches=None):
+        """
+        Remove the least recently used entries from caches holding more 
+        documents or bytes than their configured limits. Returns a dictionary
+        mapping cache names to the number of entries evicted.
+        """
+        if caches is None:
+            caches = self.caches
+        evicted = {}
+        for cache in caches:
+            limits = self.cache_limits(cache)
+            db = self.db[cache]
+            self._ensure_access_index(db, limits.get('ttl'))
+            
+            # Work out how many entries are over the limits
+            stats = self.db.command('collstats', cache)
+            count = stats.get('count', 0)
+            size = stats.get('size', 0)
+            excess = 0
+            if limits.get('documents') and count > limits['documents']:
+                excess = count - limits['documents']
+            if limits.get('bytes') and size > limits['bytes'] and count:
+                average_size = float(size) / count
+                excess = max(excess, 
+                    int((size - limits['bytes']) / average_size) + 1)
             
-        cacheinfo = self.db.cacheinfo.find_one({MONGO_ID: cache})
-        if cacheinfo is None:
-            # Cache info entry doesn't yet exist: assume caches are invalid
+            # Remove the least recently used entries in batches
+            removed = 0
+            while removed < excess:
+                batch = min(excess - removed, 1000)
+                cursor = db.find({}, [MONGO_ID]) \
+                    .sort(LAST_ACCESS, pymongo.ASCENDING).limit(batch)
+                ids = [object[MONGO_ID] for object in cursor]
+                if not ids:
+                    break
+                db.remove({MONGO_ID: {'$in': ids}})
+                removed += len(ids)
+            
+            if removed:
+                log.info('evicted %d entries from cache %s', removed, cache)
+                self.db.cacheinfo.update({MONGO_ID: cache}, {
+                    '$inc': {'evicted': removed}, 
+                    '$set': {'lastEviction': datetime.utcnow()}}, upsert=True)
+            evicted[cache] = removed
+        return evicted
+        
+    def _ensure_access_index(self, db, ttl=None):
+        """
+        Index the last access time of cache entries. With a ttl, entries not
+        used for that many seconds are expired by mongodb. An existing index
+        with another ttl is changed in place with collMod, or rebuilt if it
+        has to gain or lose its ttl.
+        """
+        ttl = ttl or None
+        name = LAST_ACCESS + '_1'
+        index = db.index_information().get(name)
+        if index is not None and index.get('expireAfterSeconds') != ttl:
+            if ttl is not None and 'expireAfterSeconds' in index:
+                log.info('changing ttl of cache %s to %ds', db.name, ttl)
+                self.db.command('collMod', db.name, index={
+                    'keyPattern': {LAST_ACCESS: 1}, 
+                    'expireAfterSeconds': ttl})
+                return
+            log.info('rebuilding last access index of cache %s', db.name)
+            db.drop_index(name)
+        if ttl is not None:
+            # Entries not used for a while are expired by mongodb
+            db.ensure_index(LAST_ACCESS, expireAfterSeconds=ttl)
+        else:
+            db.ensure_index(LAST_ACCESS)
+        
+    def cache_limits(self, cache):
+        limits = dict(settings.LIMAS_CACHE_DEFAULT_LIMITS)
+        limits.update(settings.LIMAS_CACHE_LIMITS.get(cache, {}))
+        return limits
+        
+    def _touch(self, dbname, objects):
+        """
+        Record access to cached documents read from mongodb. Each document
+        is updated at most once every LIMAS_CACHE_ACCESS_RESOLUTION seconds,
+        without waiting for the write to be acknowledged.
+        """
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=settings.LIMAS_CACHE_ACCESS_RESOLUTION)
+        touched = [object for object in objects 
+            if object.get(LAST_ACCESS) is None or object[LAST_ACCESS] < cutoff]
+        if not touched:
+            return
+        ids = [object[MONGO_ID] for object in touched]
+        self.db[dbname].update({MONGO_ID: {'$in': ids}}, 
+            {'$set': {LAST_ACCESS: now}}, multi=True, w=0)
+        for object in touched:
+            object[LAST_ACCESS] = now
+    
+    def cache_generation(self, cache):
+        """
+        Generation that up to date entries of a cache belong to: the later
+        of the last limas index update and the last time the cache was 
+        cleared. None if limas has not been reachable yet, in which case all
+        cached entries are assumed to be good.
+        """
+        generation = self.watcher.generation
+        if generation is None:
+            return None
+        return max(generation, self.cache_cleared(cache))
+        
+    def cache_cleared(self, cache):
+        """
+        Time the cache was last cleared with clear_caches, or 0
+        """
+        cache_ages = self.cache_ages.generation or {}
+        return cache_ages.get(cache, 0)
+        
+    def _is_stale(self, dbname, object):
+        generation = self.cache_generation(dbname)
+        if generation is None:
+            return False
+        return object.get(GENERATION) is None or object[GENERATION] < generation
+        
+    def _can_serve_stale(self, dbname, object=None):
+        if not settings.LIMAS_CACHE_STALE_WHILE_REVALIDATE:
+            return False
+        # Entries are never served once the cache has been cleared
+        if object is not None and (
+            object.get(GENERATION) or 0) < self.cache_cleared(dbname):
+            return False
+        # Entries one generation behind became stale when the current 
+        # generation began. For older ones that time is not known, so their
+        # own generation is used instead, which overestimates the staleness.
+        became_stale = self.cache_generation(dbname)
+        if object is not None:
+            previous = self.watcher.previous
+            if previous is None or (object.get(GENERATION) or 0) < previous:
+                became_stale = object.get(GENERATION) or 0
+        staleness = time.time() - became_stale
+        return staleness <= settings.LIMAS_CACHE_MAX_STALENESS
+        
+    def _local_get(self, dbname, id):
+        if self.pending_writes:
+            with self.pending_lock:
+                object = self.pending_writes.get((dbname, id))
+            if object is not None:
+                return copy_document(object)
+        if self.local_cache is None:
+            return None
+        return self.local_cache.get(
+            (dbname, id), self.cache_generation(dbname))
+        
+    def _local_put(self, dbname, id, object):
+        if self.local_cache is None:
+            return
+        ttl = settings.LIMAS_LOCAL_CACHE_TTLS.get(
+            dbname, settings.LIMAS_LOCAL_CACHE_TTL)
+        self.local_cache.put(
+            (dbname, id), object, self.cache_generation(dbname), ttl)
+    
+    def _covers(self, object, requested):
+        # Markers hold nothing that depends on the options
+        return object.get(NOT_SEGMENT) or self._options_cover(
+            object.get(OPTIONS), requested)
+        
+    def _options_cover(self, options, requested):
+        """
+        True if a document fetched with options contains everything that a 
+        request with the requested options would return.
+        """
+        if requested is None:
             return True
+        if options is None:
+            return False
+        for name in set(options) | set(requested):
+            have = options.get(name)
+            want = requested.get(name)
+            if name in self.sliced_options:
+                if want is None or have is None:
+                    if want != have:
+                        return False
+                elif have < want:
+                    return False
+            elif isinstance(have, bool) or isinstance(want, bool):
+                if want and not have:
+                    return False
+            elif have != want:
+                return False
+        return True
         
-        # Find out the cache age
-        cache_age = cacheinfo['age']
+    def _merge_options(self, options, requested):
+        """
+        Smallest set of options covering both options and requested
+        """
+        if options is None or requested is None:
+            return requested
+        merged = dict(requested)
+        for name, have in options.iteritems():
+            want = requested.get(name)
+            if name in self.sliced_options:
+                if have is not None and want is not None:
+                    merged[name] = max(have, want)
+            elif isinstance(have, bool) or isinstance(want, bool):
+                merged[name] = bool(have) or bool(want)
+        return merged
         
-        # Return true of cache is older than last modified time of limas
-        return cache_age < last_modified
+    def _narrow(self, object, requested):
+        """
+        Project a document fetched with a superset of the requested options
+        down to what a request for exactly those options would return.
+        """
+        options = object.get(OPTIONS)
+        if requested is None or options is None or options == requested:
+            return object
+        for name, field in self.option_fields.iteritems():
+            if options.get(name) and not requested.get(name):
+                object.pop(field, None)
+                for embedded in ('videos', 'segments'):
+                    for item in object.get(embedded, {}).itervalues():
+                        item.pop(field, None)
+        for name in self.sliced_options:
+            limit = requested.get(name)
+            if limit is not None and 'ranking' in object:
+                object['ranking'] = object['ranking'][:limit]
+        object[OPTIONS] = requested
+        return object
         
-    def clear_cache_if_invalid(self, cache):
-        if self.cache_is_invalid(cache):
-            log.info('clearing cache: %s', cache)
-            self.clear_caches([cache])
+    def _public(self, object):
+        """
+        Remove the cache bookkeeping fields from a document being returned
+        """
+        for field in (OPTIONS, GENERATION, LAST_ACCESS):
+            object.pop(field, None)
+        return object
+        
+    def _fetch(self, func, args, options):
+        if options is None:
+            return func(self, *args)
+        return func(self, *args, **options)
     
-    def _cache(self, dbname, func, id, *args, **kwargs):
-        self.clear_cache_if_invalid(dbname)
+    def _cache(self, dbname, func, id, options, *args):
+        """
+        Return the document with the given id from the cache, calling
+        func(self, *args, **options) to fetch it on a miss. A cached document
+        fetched with a superset of the requested options is narrowed down and
+        returned. Otherwise the document is refetched with the union of both
+        sets of options, so the cache keeps the superset.
+        
+        In stale-while-revalidate mode, documents from an older generation 
+        are returned as is and refreshed in the background, provided the 
+        maximum staleness has not been exceeded.
+        """
         db = self.db[dbname]
-        object = db.find_one({MONGO_ID: id})
+        started = time.time()
+        object = self._local_get(dbname, id)
         if object is None:
-            self.on_cache_miss(dbname, id)
-            object = func(self, *args, **kwargs)
+            object = db.find_one({MONGO_ID: id})
+            if object is not None:
+                self._touch(dbname, [object])
+                self._local_put(dbname, id, object)
+        self.on_cache_read(dbname, time.time() - started)
+        if object is not None and self._covers(object, options):
+            if not self._is_stale(dbname, object):
+                self.on_cache_hit(dbname, id)
+                return self._public(self._narrow(object, options))
+            if self._can_serve_stale(dbname, object):
+                self.on_cache_stale(dbname, id)
+                self._revalidate(dbname, func, id, args, object.get(OPTIONS))
+                return self._public(self._narrow(object, options))
+        self.on_cache_miss(dbname, id)
+        fetch_options = options
+        if object is not None:
+            fetch_options = self._merge_options(object.get(OPTIONS), options)
+        key = (dbname, id, self._options_key(fetch_options))
+        started = time.time()
+        object = self.inflight.do(key, self._fill, 
+            dbname, func, id, args, fetch_options)
+        if object is None:
+            return None
+        self.on_cache_fill(dbname, time.time() - started, [object])
+        self._local_put(dbname, id, object)
+        return self._public(self._narrow(object, options))
+        
+    def _revalidate(self, dbname, func, id, args, options):
+        """
+        Refresh a stale cache entry in a background thread (a greenlet when
+        gevent has monkey patched the process)
+        """
+        key = (dbname, id, self._options_key(options))
+        with self.refreshing_lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+            
+        # Use a separate instance: the rpc proxy is not thread safe
+        service = type(self)()
+        def refresh():
+            try:
+                object = service.inflight.do(key, service._fill, 
+                    dbname, func, id, args, options)
+                if object is not None:
+                    service._local_put(dbname, id, object)
+            except Exception, e:
+                log.error('error refreshing %s in %s: %s', id, dbname, e)
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.discard(key)
+        spawn(refresh)
+        
+    @staticmethod
+    def _options_key(options):
+        if options is None:
+            return None
+        return tuple(sorted(options.iteritems()))
+        
+    def _fill(self, dbname, func, id, args, options):
+        """
+        Fetch a document and store it in the cache. Holds a lease on the 
+        cache entry while fetching, so that other processes missing on the
+        same entry wait for the result instead of fetching it too.
+        """
+        db = self.db[dbname]
+        lease = u'{}:{}'.format(dbname, id)
+        owner = self._acquire_lease(lease)
+        if owner is None:
+            object = self._wait_for_lease(lease, db, id, options)
+            if object is not None:
+                return object
+        try:
+            generation = self.cache_generation(dbname)
+            object = self._fetch(func, args, options)
             if object is not None:
                 object[MONGO_ID] = id
+                object[OPTIONS] = options
+                object[GENERATION] = generation
+                object[LAST_ACCESS] = datetime.utcnow()
                 db.save(object)
-        else:
-            self.on_cache_hit(dbname, id)
+        finally:
+            if owner is not None:
+                self.db.cacheleases.remove({MONGO_ID: lease, 'owner': owner})
         return object
         
+    def _acquire_lease(self, lease):
+        """
+        Returns an owner token if the lease was acquired, None otherwise
+        """
+        owner = uuid.uuid4().hex
+        now = time.time()
+        expires = now + settings.LIMAS_CACHE_LEASE_TIMEOUT
+        try:
+            self.db.cacheleases.insert(
+                {MONGO_ID: lease, 'owner': owner, 'expires': expires})
+        except DuplicateKeyError:
+            # Take over leases abandoned by crashed or stuck processes
+            result = self.db.cacheleases.update(
+                {MONGO_ID: lease, 'expires': {'$lt': now}},
+                {'$set': {'owner': owner, 'expires': expires}})
+            if not result or result.get('n', 0) != 1:
+                return None
+        return owner
+        
+    def _acquire_leases(self, leases):
+        """
+        Acquire several leases with one bulk insert. Returns the owner token
+        and the set of leases that were acquired.
+        """
+        owner = uuid.uuid4().hex
+        now = time.time()
+        expires = now + settings.LIMAS_CACHE_LEASE_TIMEOUT
+        bulk = self.db.cacheleases.initialize_unordered_bulk_op()
+        for lease in leases:
+            bulk.insert({MONGO_ID: lease, 'owner': owner, 'expires': expires})
+        try:
+            bulk.execute()
+        except BulkWriteError:
+            # Some are held by others: take over the abandoned ones
+            self.db.cacheleases.update(
+                {MONGO_ID: {'$in': leases}, 'expires': {'$lt': now}},
+                {'$set': {'owner': owner, 'expires': expires}}, multi=True)
+            acquired = self.db.cacheleases.find(
+                {MONGO_ID: {'$in': leases}, 'owner': owner}, [MONGO_ID])
+            return owner, set(lease[MONGO_ID] for lease in acquired)
+        return owner, set(leases)
+        
+    def _wait_for_lease(self, lease, db, id, options):
+        """
+        Wait for the holder of a lease to store the document. Returns None 
+        if the lease is released or expires without a usable document.
+        """
+        return self._wait_for_leases({id: lease}, db, options).get(id)
+        
+    def _wait_for_leases(self, leases, db, options):
+        """
+        Wait for the holders of leases (a dictionary mapping ids to leases) 
+        to store the documents, polling for all of them at once. Returns a
+        dictionary of the usable documents stored before their lease was 
+        released, or before the lease timeout.
+        """
+        deadline = time.time() + settings.LIMAS_CACHE_LEASE_TIMEOUT
+        objects = {}
+        waiting = list(leases)
+        while True:
+            held = set(lease[MONGO_ID] for lease in self.db.cacheleases.find(
+                {MONGO_ID: {'$in': [leases[id] for id in waiting]}}, 
+                [MONGO_ID]))
+            for object in db.find({MONGO_ID: {'$in': waiting}}):
+                if (not self._is_stale(db.name, object) and 
+                    self._covers(object, options)):
+                    objects[object[MONGO_ID]] = object
+            waiting = [id for id in waiting 
+                if id not in objects and leases[id] in held]
+            if not waiting or time.time() >= deadline:
+                return objects
+            time.sleep(settings.LIMAS_CACHE_LEASE_POLL_INTERVAL)
+        
+    def _cache_many(self, dbname, func, ids, options):
+        """
+        Batched version of _cache. Reads all ids from the cache with a single
+        $in query, then calls func(self, missed_ids, **options) once for the
+        misses. func must return a list aligned with missed_ids. Returns a 
+        list of objects aligned with ids.
+        """
+        db = self.db[dbname]
+        started = time.time()
+        objects = {}
+        for id in ids:
+            object = self._local_get(dbname, id)
+            if object is not None:
+                objects[id] = object
+        uncached = [id for id in ids if id not in objects]
+        if uncached:
+            found = list(db.find({MONGO_ID: {'$in': uncached}}))
+            self._touch(dbname, found)
+            for object in found:
+                objects[object[MONGO_ID]] = object
+                self._local_put(dbname, object[MONGO_ID], object)
+        self.on_cache_read(dbname, time.time() - started)
+        missed = []
+        stale = []
+        fetch_options = options
+        for id in ids:
+            object = objects.get(id)
+            if id in missed or id in stale:
+                continue
+            if object is not None and self._covers(object, options):
+                if not self._is_stale(dbname, object):
+                    self.on_cache_hit(dbname, id)
+                    continue
+                if self._can_serve_stale(dbname, object):
+                    self.on_cache_stale(dbname, id)
+                    stale.append(id)
+                    continue
+            self.on_cache_miss(dbname, id)
+            missed.append(id)
+            if object is not None:
+                fetch_options = self._merge_options(
+                    object.get(OPTIONS), fetch_options)
+        if missed:
+            started = time.time()
+            fetched = self._fill_many(dbname, func, missed, fetch_options)
+            self.on_cache_fill(dbname, time.time() - started, fetched.values())
+            # Missed entries that are no longer found are not returned
+            for id in missed:
+                objects.pop(id, None)
+            objects.update(fetched)
+        if stale:
+            # Refresh with the options the entries were stored with, so a 
+            # narrower request does not downgrade them
+            refresh_options = options
+            for id in stale:
+                refresh_options = self._merge_options(
+                    objects[id].get(OPTIONS), refresh_options)
+            self._revalidate_many(dbname, func, stale, refresh_options)
+        return [self._public(self._narrow(objects[id], options)) 
+            if id in objects else None for id in ids]
+            
+    def _fill_many(self, dbname, func, ids, options):
+        """
+        Fetch several documents with one call to func and store them in the
+        cache. Returns a dictionary of the documents that were found.
+        
+        As with _fill, concurrent fills of the same entries in this process
+        are coalesced, and a lease is held on each entry while fetching so 
+        that other processes wait for it instead of fetching it too.
+        """
+        key = (dbname, tuple(ids), self._options_key(options))
+        return self.inflight.do(key, self._fill_leased, 
+            dbname, func, ids, options)
+        
+    def _fill_leased(self, dbname, func, ids, options):
+        db = self.db[dbname]
+        leases = dict((id, u'{}:{}'.format(dbname, id)) for id in ids)
+        owner, acquired = self._acquire_leases(leases.values())
+        owned = [id for id in ids if leases[id] in acquired]
+        objects = {}
+        try:
+            if owned:
+                objects.update(self._fetch_many(dbname, func, owned, options))
+        finally:
+            if owned:
+                self.db.cacheleases.remove({MONGO_ID: {'$in': 
+                    [leases[id] for id in owned]}, 'owner': owner})
+        
+        # Wait for the entries leased by others, fetching any that they did
+        # not store
+        others = dict((id, leases[id]) for id in ids 
+            if leases[id] not in acquired)
+        if others:
+            objects.update(self._wait_for_leases(others, db, options))
+        unfetched = [id for id in ids if id in others and id not in objects]
+        if unfetched:
+            objects.update(self._fetch_many(dbname, func, unfetched, options))
+        return objects
+        
+    def _fetch_many(self, dbname, func, ids, options):
+        generation = self.cache_generation(dbname)
+        fetched = self._fetch(func, (ids,), options)
+        return self._store_many(dbname, zip(ids, fetched), options, generation)
+        
+    def _store_many(self, dbname, items, options, generation):
+        """
+        Store (id, document) pairs fetched with the given options in a cache,
+        skipping None documents. Returns a dictionary of the stored documents.
+        """
+        now = datetime.utcnow()
+        objects = {}
+        for id, object in items:
+            if object is not None:
+                object[MONGO_ID] = id
+                object[OPTIONS] = options
+                object[GENERATION] = generation
+                object[LAST_ACCESS] = now
+                objects[id] = object
+                self._local_put(dbname, id, object)
+        self._bulk_save(self.db[dbname], objects.values())
+        return objects
+        
+    def _revalidate_many(self, dbname, func, ids, options):
+        """
+        Refresh several stale cache entries in one background call
+        """
+        option_key = self._options_key(options)
+        with self.refreshing_lock:
+            ids = [id for id in ids 
+                if (dbname, id, option_key) not in self.refreshing]
+            keys = set((dbname, id, option_key) for id in ids)
+            self.refreshing.update(keys)
+        if not ids:
+            return
+            
+        # Use a separate instance: the rpc proxy is not thread safe
+        service = type(self)()
+        def refresh():
+            try:
+                service._fill_many(dbname, func, ids, options)
+            except Exception, e:
+                log.error('error refreshing %s in %s: %s', ids, dbname, e)
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.difference_update(keys)
+        spawn(refresh)
+        
+    def _bulk_save(self, db, objects):
+        """
+        Upsert a list of documents into a cache collection in one round trip
+        """
+        if not objects:
+            return
+        bulk = db.initialize_unordered_bulk_op()
+        for object in objects:
+            bulk.find({MONGO_ID: object[MONGO_ID]}).upsert().replace_one(object)
+        bulk.execute()
+        
     def _query_key(self, query):
         encoded_query = encode_query(query['data']).encoded_query
         return hashlib.md5(encoded_query.encode('utf-8')).hexdigest()
         
     def lookup_video(self, uri, **kwargs):
         func = LimasService.lookup_video
-        return self._cache('videos', func, uri, uri, **kwargs)
+        options = self.make_options(self.lookup_options, kwargs)
+        return self._cache('videos', func, uri, options, uri)
+        
+    def lookup_videos(self, uris, **kwargs):
+        func = LimasService.lookup_videos
+        uris = map(self.fix_uri, uris)
+        options = self.make_options(self.lookup_options, kwargs)
+        return self._cache_many('videos', func, uris, options)
+        
+    def lookup_segments(self, uris, **kwargs):
+        func = CachedLimasService._fetch_segments
+        uris = map(self.fix_uri, uris)
+        options = self.make_options(self.lookup_options, kwargs)
+        segments = self._cache_many('segments', func, uris, options)
+        return [None if segment is None or segment.get(NOT_SEGMENT) 
+            else segment for segment in segments]
         
     def lookup_segment(self, uri, **kwargs):
-        func = LimasService.lookup_segment
-        return self._cache('segments', func, uri, uri, **kwargs)
+        return self.lookup_segments([uri], **kwargs)[0]
         
     def lookup_asset(self, uri, **kwargs):
-        func = LimasService.lookup_asset
-        return self._cache('assets', func, uri, uri, **kwargs)
+        return self.lookup_assets([uri], **kwargs)[0]
+        
+    def lookup_assets(self, uris, **kwargs):
+        """
+        Assemble assets from the segments and videos caches. Returns a list
+        aligned with uris containing None for any unknown URI.
+        """
+        func = CachedLimasService._fetch_segments
+        uris = map(self.fix_uri, uris)
+        options = self.make_options(self.lookup_options, kwargs)
+        segments = self._cache_many('segments', func, uris, options)
+        video_uris = []
+        for uri, segment in zip(uris, segments):
+            if segment is not None:
+                video_uri = uri if segment.get(NOT_SEGMENT) \
+                    else segment['videoUri']
+                if video_uri not in video_uris:
+                    video_uris.append(video_uri)
+        videos = dict(zip(video_uris, 
+            self.lookup_videos(video_uris, **kwargs)))
+        assets = []
+        for uri, segment in zip(uris, segments):
+            if segment is None:
+                assets.append(None)
+            elif segment.get(NOT_SEGMENT):
+                assets.append({
+                    'uri': uri, 
+                    'type': 'Video', 
+                    'video': videos[uri], 
+                    'segment': None})
+            else:
+                assets.append({
+                    'uri': uri, 
+                    'type': 'Segment', 
+                    'video': videos[segment['videoUri']], 
+                    'segment': segment})
+        return assets
+        
+    def _fetch_segments(self, uris, **options):
+        """
+        Lookup URIs for the segments cache using a single lookup() RPC. The 
+        videos among them are stored in the videos cache and get a marker
+        in place of a segment, so they are not looked up again.
+        """
+        generation = self.cache_generation('videos')
+        segments = []
+        videos = []
+        for uri, item in zip(uris, self._lookup(uris, **options)):
+            segment = self._as_segment(uri, item)
+            if segment is not None:
+                segments.append(self.postprocess(segment))
+                continue
+            video = self._as_video(uri, item)
+            if video is None:
+                segments.append(None)
+                continue
+            videos.append((uri, self.postprocess(video)))
+            segments.append({NOT_SEGMENT: True})
+        self._store_many('videos', videos, options or None, generation)
+        return segments
         
     def find_related_videos(self, uri, **kwargs):
         func = LimasService.find_related_videos
-        return self._cache('relatedvideos', func, uri, uri, **kwargs)
+        options = self.make_options(self.related_options, kwargs)
+        return self._cache('relatedvideos', func, uri, options, uri)
         
     def find_related_segments(self, uri, **kwargs):
         func = LimasService.find_related_segments
-        return self._cache('relatedsegments', func, uri, uri, **kwargs)
+        options = self.make_options(self.related_options, kwargs)
+        return self._cache('relatedsegments', func, uri, options, uri)
         
     def get_keyframes(self, uri):
         func = LimasService.get_keyframes
-        return self._cache('keyframes', func, uri, uri)
+        return self._cache('keyframes', func, uri, None, uri)
         
     def get_transcript(self, uri):
         func = LimasService.get_transcript
-        return self._cache('transcripts', func, uri, uri)
+        return self._cache('transcripts', func, uri, None, uri)
         
     def get_face_tracks(self, uri):
         func = LimasService.get_face_tracks
-        return self._cache('facetracks', func, uri, uri)
+        return self._cache('facetracks', func, uri, None, uri)
         
     def get_collection_statistics(self):
         func = LimasService.get_collection_statistics
-        return self._cache('collectionstats', func, settings.DEFAULT_COLLECTION)
+        return self._cache('collectionstats', func, 
+            settings.DEFAULT_COLLECTION, None)
     
     def suggest(self, query, **kwargs):
         func = LimasService.suggest
         key = self._query_key(query)
-        return self._cache('suggestions', func, key, query, **kwargs)
+        options = self.make_options(self.suggest_options, kwargs)
+        return self._cache('suggestions', func, key, options, query)
     
     def search(self, query, **kwargs):
-        func = LimasService.search
+        results, options = self._search_results(query, **kwargs)
+        if results is None:
+            return None
+        return self._rehydrate(results, results.get('ranking', []), options)
+        
+    def search_page(self, query, first=0, count=50, **kwargs):
+        step = kwargs.pop('limit', self.search_options['limit'])
+        depth = self.page_depth(first, count, step)
+        results, options = self._search_results(query, limit=depth, **kwargs)
+        if results is None:
+            return None
+        ranking = results.get('ranking', [])[first:first + count]
+        results = self._rehydrate(results, ranking, options)
+        return self.make_page(results, first, count, depth)
+        
+    def _search_results(self, query, **kwargs):
+        func = CachedLimasService._fetch_results
         key = self._query_key(query)
-        results = self._cache('results', func, key, query, **kwargs)
-        if results is not None:
-            # Update segments cache
-            if 'segments' in results:
-                for uri, segment in results['segments'].iteritems():
-                    segment[MONGO_ID] = uri
-                    self.db.segments.save(segment)
-            # Update videos cache
-            if 'videos' in results:
-                for uri, video in results['videos'].iteritems():
-                    video[MONGO_ID] = uri
-                    video['videoUri'] = uri
-                    self.db.videos.save(video) 
+        options = self.make_options(self.search_options, kwargs)
+        return self._cache('results', func, key, options, query), options
+        
+    def _item_options(self, options):
+        # Embedded documents are fetched with the search options
+        item_options = dict(options)
+        for name in self.sliced_options:
+            item_options.pop(name, None)
+        return item_options
+        
+    def _fetch_results(self, query, **options):
+        """
+        Search, storing the embedded segments and videos in their own caches.
+        The results keep only the ranking (and other fields), with the 
+        parent video URI of each segment in 'segmentParents'.
+        """
+        # Generations from before the fetch, so a clear during it is not missed
+        generations = dict((dbname, self.cache_generation(dbname))
+            for dbname in ('segments', 'videos'))
+        results = LimasService.search(self, query, **options)
+        item_options = self._item_options(options)
+        now = datetime.utcnow()
+        segments = results.pop('segments', {})
+        videos = results.pop('videos', {})
+        for uri, video in videos.iteritems():
+            video['videoUri'] = uri
+        
+        # Mark the videos in the ranking as such in the segments cache, so
+        # assets can be built for every result item from the caches
+        items = dict(segments)
+        for result in results.get('ranking', []):
+            uri = result.get('uri')
+            if uri in videos and uri not in segments:
+                items[uri] = {NOT_SEGMENT: True}
+        writes = []
+        for dbname, items in (('segments', items), ('videos', videos)):
+            generation = generations[dbname]
+            for uri, item in items.iteritems():
+                item[MONGO_ID] = uri
+                item[OPTIONS] = item_options
+                item[GENERATION] = generation
+                item[LAST_ACCESS] = now
+                self._local_put(dbname, uri, item)
+            writes.append((dbname, items.values()))
+        if settings.LIMAS_CACHE_DEFER_SEARCH_WRITES:
+            # Served from pending_writes until they are in mongodb
+            with self.pending_lock:
+                for dbname, objects in writes:
+                    for object in objects:
+                        self.pending_writes[dbname, object[MONGO_ID]] = object
+            spawn(self._write_deferred, writes)
+        else:
+            for dbname, objects in writes:
+                self._bulk_save(self.db[dbname], objects)
+        results['segmentParents'] = [[uri, segment.get('videoUri')] 
+            for uri, segment in segments.iteritems()]
+        return results
+        
+    def _write_deferred(self, writes):
+        try:
+            for dbname, objects in writes:
+                self._bulk_save(self.db[dbname], objects)
+        except Exception, e:
+            log.error('unable to write search results to the caches: %s', e)
+        finally:
+            with self.pending_lock:
+                for dbname, objects in writes:
+                    for object in objects:
+                        key = (dbname, object[MONGO_ID])
+                        if self.pending_writes.get(key) is object:
+                            del self.pending_writes[key]
+        
+    def _rehydrate(self, results, ranking, options):
+        """
+        Attach the segments and videos referred to by the given ranking
+        entries to normalized search results, reading them from the segments
+        and videos caches.
+        """
+        if 'segmentParents' not in results:
+            # Stored before results were normalized
+            return results
+        parents = dict(results.pop('segmentParents'))
+        segment_uris = []
+        video_uris = []
+        for item in ranking:
+            uri = item.get('uri')
+            if uri in parents:
+                segment_uris.append(uri)
+                uri = parents[uri]
+            if uri not in video_uris:
+                video_uris.append(uri)
+        item_options = self._item_options(options)
+        segments = self._cache_many('segments', LimasService.lookup_segments,
+            segment_uris, item_options)
+        videos = self._cache_many('videos', LimasService.lookup_videos, 
+            video_uris, item_options)
+        results['segments'] = dict((uri, segment) for uri, segment 
+            in zip(segment_uris, segments) if segment is not None)
+        results['videos'] = dict((uri, video) for uri, video 
+            in zip(video_uris, videos) if video is not None)
         return results
 
 # Use cached service if enabled
@@ -425,3 +1413,52 @@ if settings.LIMAS_CACHE_ENABLED:
     Limas = CachedLimasService
 else:
     Limas = LimasService
+    
+class AsyncLimasService(object):
+    """
+    Asynchronous interface to the limas service for use under gevent.
+    
+    Has the same methods as LimasService, but each call that talks to limas
+    (or the caches) runs in a greenlet from a process-wide pool of at most 
+    LIMAS_ASYNC_CONCURRENCY greenlets and returns the gevent Greenlet 
+    immediately; use ``get()`` to wait for the result or re-raise the error::
+    
+        limas = AsyncLimasService()
+        video = limas.lookup_video(uri)
+        related = limas.find_related_videos(uri)
+        gevent.joinall([video, related])
+        
+    Other attributes, such as ``fix_uri`` and ``make_query_object``, are 
+    those of the wrapped service. Calls are only concurrent when gevent has 
+    monkey patched the process (as services/gevent-server.py does), since 
+    limas is reached through the pooled jsonrpclib transport and mongodb 
+    through pymongo. The number of simultaneous limas requests is bounded 
+    by LIMAS_CONNECTION_POOL_SIZE.
+    """
+    
+    # Public methods of LimasService that do not talk to limas
+    local_methods = ('batch', 'postprocess')
+    
+    # The methods run in greenlets: all other public methods of the service
+    # (static methods, properties, and class attributes are not included)
+    methods = frozenset([name for name, attr in vars(LimasService).iteritems()
+        if not name.startswith('_') and name not in local_methods 
+        and inspect.isfunction(attr)])
+    
+    pool = None
+    
+    def __init__(self, limas=None):
+        from gevent.pool import Pool
+        if AsyncLimasService.pool is None:
+            AsyncLimasService.pool = Pool(settings.LIMAS_ASYNC_CONCURRENCY)
+        self.limas = limas if limas is not None else Limas()
+        
+    def __getattr__(self, name):
+        attr = getattr(self.limas, name)
+        if name not in self.methods:
+            return attr
+        pool = self.pool
+        def call(*args, **kwargs):
+            # Blocks while the pool is full
+            return pool.spawn(attr, *args, **kwargs)
+        return call
@@ -0,0 +1,212 @@
+# Author: Kevin McGuinness <kevin.mcguinness@dcu.ie>
+#
+"""
+Process-wide helpers for the LIMAS response cache
+"""
+import threading
+import logging
+import time
+import bson
+import sys
+
+from collections import OrderedDict
+
+log = logging.getLogger('axesresearch')
+
+class GenerationWatcher(object):
+    """
+    Tracks the generation of a shared resource, such as the LIMAS index (the
+    time it was last changed) or the cache ages stored in mongodb.
+    
+    The resource is polled using ``poll`` at most once every ``interval`` 
+    seconds per process, and the result is shared between all threads and 
+    greenlets. Errors listed in ``errors`` are logged and the last known 
+    generation is kept, or None if the resource has never been reached.
+    The generation before the current one, if this process has seen it 
+    change, is kept in ``previous``.
+    """
+    
+    def __init__(self, poll, interval, errors=(Exception,)):
+        self.poll = poll
+        self.interval = interval
+        self.errors = errors
+        self._generation = None
+        self._checked = None
+        self.previous = None
+        self._lock = threading.Lock()
+    
+    @property
+    def expired(self):
+        return (self._checked is None or 
+            time.time() - self._checked >= self.interval)
+    
+    @property
+    def generation(self):
+        if self.expired:
+            # Only one caller polls, the rest carry on with the last known 
+            # generation. Callers only wait if nothing has been polled yet.
+            if self._lock.acquire(self._checked is None):
+                try:
+                    if self.expired:
+                        self.refresh()
+                finally:
+                    self._lock.release()
+        return self._generation
+        
+    def refresh(self):
+        try:
+            generation = self.poll()
+            if self._generation is not None and generation != self._generation:
+                self.previous = self._generation
+            self._generation = generation
+        except self.errors, e:
+            log.error('unable to poll generation: %s', e)
+        self._checked = time.time()
+        
+    def invalidate(self):
+        """
+        Force the generation to be polled on next access
+        """
+        self._checked = None
+
+
+def copy_document(document):
+    """
+    Copy the dicts and lists of a decoded document, sharing the immutable 
+    leaf values. Much cheaper than copy.deepcopy for JSON-like data.
+    """
+    if isinstance(document, dict):
+        return dict((k, copy_document(v)) for k, v in document.iteritems())
+    elif isinstance(document, list):
+        return [copy_document(v) for v in document]
+    return document
+    
+def document_size(document):
+    """
+    Approximate size of a document in bytes
+    """
+    return len(bson.BSON.encode(document))
+
+def spawn(func, *args, **kwargs):
+    """
+    Run a function in a background daemon thread. When gevent has monkey
+    patched the process this is a greenlet.
+    """
+    thread = threading.Thread(target=func, args=args, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+class LRUCache(object):
+    """
+    Thread safe in-memory least recently used cache bounded both by number
+    of entries and by (approximate) size in bytes. 
+    
+    Each entry is stored with an expiry time and the generation it was 
+    stored under, and is only returned for that same generation. Values are
+    copied on the way in and on the way out so that callers are free to 
+    modify them.
+    """
+    
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, size, expires, entry_generation = entry
+            if entry_generation != generation or expires <= time.time():
+                self.size -= size
+                return None
+            # Re-insert to mark as most recently used
+            self._entries[key] = entry
+        return copy_document(value)
+        
+    def put(self, key, value, generation, ttl):
+        size = document_size(value)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        entry = (copy_document(value), size, time.time() + ttl, generation)
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self._entries[key] = entry
+            self.size += size
+            while (len(self._entries) > self.max_entries or 
+                self.size > self.max_bytes):
+                evicted_key, evicted_entry = self._entries.popitem(last=False)
+                self.size -= evicted_entry[1]
+                
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+        
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class SingleFlight(object):
+    """
+    Deduplicates concurrent calls for the same key within a process. The 
+    first caller runs the function; callers arriving while it runs wait for
+    it to finish and receive a copy of its result (or its exception). The 
+    first caller also gets a copy if anyone waited, so that every caller is
+    free to modify its result.
+    
+    Uses threading primitives, so it is greenlet aware when gevent has
+    monkey patched the process.
+    """
+    
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+            else:
+                call.waiters += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return copy_document(call.result)
+        
+        try:
+            call.result = func(*args, **kwargs)
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        # No one else can wait for the call once it has been removed
+        if call.waiters:
+            return copy_document(call.result)
+        return call.result
@@ -0,0 +1,76 @@
+# Author: Kevin McGuinness <kevin.mcguinness@dcu.ie>
+#
+"""
+Write-behind buffering of counter updates
+"""
+import threading
+import logging
+import atexit
+
+log = logging.getLogger('axesresearch')
+
+class CounterBuffer(object):
+    """
+    Adds up counter increments in memory and writes them in batches.
+    
+    Pending updates are passed to ``flush``, as a dict mapping each key to
+    a (counts, latest) pair, every ``interval`` seconds, as soon as more 
+    than ``max_keys`` keys are pending, and when the process exits. counts
+    holds the summed increments and latest the most recent value of each 
+    timestamp-like field. If a flush fails its updates are kept for the 
+    next one, so at most ``interval`` seconds of updates are lost if the 
+    process is killed. An interval of 0 flushes every update immediately.
+    """
+    
+    def __init__(self, flush, interval, max_keys):
+        self.flush_function = flush
+        self.interval = interval
+        self.max_keys = max_keys
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = threading.Event()
+        atexit.register(self.close)
+        
+    def add(self, key, counts, latest=None):
+        with self._lock:
+            self._add(key, counts, latest or {})
+            pending = len(self._pending)
+            if self._thread is None and self.interval:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        if not self.interval or pending > self.max_keys:
+            self.flush()
+            
+    def _add(self, key, counts, latest):
+        pending_counts, pending_latest = self._pending.setdefault(key, ({}, {}))
+        for name, count in counts.iteritems():
+            pending_counts[name] = pending_counts.get(name, 0) + count
+        for name, value in latest.iteritems():
+            if pending_latest.get(name) is None or value > pending_latest[name]:
+                pending_latest[name] = value
+        
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.flush()
+            
+    def close(self):
+        self._closed.set()
+        self.flush()
+            
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                self.flush_function(pending)
+            except Exception, e:
+                log.error('unable to write %d buffered counters: %s', 
+                    len(pending), e)
+                with self._lock:
+                    for key, (counts, latest) in pending.iteritems():
+                        self._add(key, counts, latest)
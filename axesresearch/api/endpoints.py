@@ -4,6 +4,7 @@
 Main API endpoints
 """
 import pymongo
+import recommender
 import tasks
 import utils
 
@@ -13,28 +14,72 @@ from utils import Api
 from models import *
 from bson.objectid import ObjectId
 from django.conf import settings
-from backend import Limas
+from backend import Limas, CachedLimasService
 from datetime import datetime
 
 MONGO_ID = '_id'
 
+# Number of top results snapshotted for the recent searches list
+TOPN_SIZE = 6
+
 api = Api("ajax")      
 mongo_client = pymongo.MongoClient()
 db = mongo_client[settings.DATABASE_NAME]
 
     
-def fetch_topn_assets(query_id, n=5):
+def fetch_topn_assets(query, n=5):
     limas = Limas()
-    query = db.queries.find_one({MONGO_ID: query_id})
     results = limas.search(query)
+    uris = [result['uri'] for result in results['ranking'][:n]]
+    # Same options as the search, so the assets come from the entries it
+    # cached
+    return limas.lookup_assets(uris, entityOccurrences=False)
+    
+def topn_assets_in_results(results, n=5):
+    videos = results.get('videos', {})
+    segments = results.get('segments', {})
     assets = []
-    for result in results['ranking']:
-        if len(assets) >= n:
-            break
-        asset = limas.lookup_asset(result['uri'])
-        assets.append(asset)
+    for result in results['ranking'][:n]:
+        segment = segments.get(result['uri'])
+        if segment is None:
+            video = videos.get(result['uri'])
+        else:
+            video = videos.get(segment['videoUri'])
+        assets.append({
+            'uri': result['uri'],
+            'type': 'Video' if segment is None else 'Segment',
+            'video': video,
+            'segment': segment})
     return assets
     
+def results_generation():
+    return CachedLimasService().cache_generation('results')
+    
+def save_topn_snapshot(query_id, assets, generation):
+    """
+    Store the parts of the top assets of a search shown in the recent 
+    searches list on the query, with the results generation they are from
+    """
+    def keyframe(item):
+        return {'thumbnailUrl': item.get('keyframe', {}).get('thumbnailUrl')}
+    snapshot = []
+    for asset in assets:
+        video = asset and asset.get('video')
+        if video is None:
+            continue
+        segment = asset.get('segment')
+        snapshot.append({
+            'uri': asset['uri'],
+            'type': asset['type'],
+            'video': {
+                'videoUri': video.get('videoUri'),
+                'metadata': {'title': video.get('metadata', {}).get('title')},
+                'keyframe': keyframe(video)},
+            'segment': {'keyframe': keyframe(segment)} if segment else None})
+    topn = {'generation': generation, 'assets': snapshot}
+    db.queries.update({MONGO_ID: query_id}, {'$set': {'topn': topn}})
+    return topn
+    
 ##    
 # Auth API
 ##
@@ -119,12 +164,40 @@ def get_query(request, id):
 def search(request, id):
     query = db.queries.find_one({MONGO_ID: ObjectId(id)})
     print query
-    results = Limas().search(query)
+    
+    # Serve a single page of the results if one is asked for
+    if 'first' in request.GET or 'count' in request.GET:
+        try:
+            first = max(0, int(request.GET.get('first', 0)))
+            count = max(1, int(request.GET.get('count', 
+                settings.DEFAULT_USER_PREFERENCES['resultsPerPage'])))
+            count = min(count, settings.SEARCH_MAX_PAGE_SIZE)
+        except ValueError:
+            return 400, {'error': 'first and count must be integers'}
+        results = Limas().search_page(query, first, count)
+    else:
+        results = Limas().search(query)
+        
+    # Snapshot the top results for the recent searches list. Pages that do
+    # not hold them are not used, the top results are read from the cached
+    # search instead.
+    if results is not None:
+        generation = results_generation()
+        if query.get('topn', {}).get('generation', False) != generation:
+            top = results
+            ranking = results.get('ranking', [])
+            if results.get('first', 0) != 0 or len(ranking) < min(TOPN_SIZE, 
+                    results.get('total', len(ranking))):
+                top = Limas().search_page(query, 0, TOPN_SIZE)
+            if top is not None:
+                save_topn_snapshot(query[MONGO_ID], 
+                    topn_assets_in_results(top, TOPN_SIZE), generation)
     
     # Attach video statistics
     if results is not None and 'videos' in results:
+        summaries = VideoStats.summaries_for_videos(results['videos'].keys())
         for uri, video in results['videos'].iteritems():
-            video['stats'] = VideoStats.summary_for_video(uri)
+            video['stats'] = summaries[uri]
      
     return results
 
@@ -156,6 +229,8 @@ def find_related_segments(request, id):
 @api.endpoint(pattern=r"^asset/(?P<id>.*?)/$", method='GET')
 def asset(request, id):
     asset = Limas().lookup_asset(id)
+    if asset is None:
+        raise Http404
     video_uri = asset['video']['videoUri']
         
     # Increment view count
@@ -223,11 +298,12 @@ def recently_viewed_videos(request):
         .order_by('-lastViewed') \
         .values_list('videoUri') \
         .distinct()[:10]
+    uris = [videoUri for (videoUri, ) in recent]
+    summaries = VideoStats.summaries_for_videos(uris)
     videos = []
-    for (videoUri, ) in recent:
-        video = limas.lookup_video(videoUri)
+    for videoUri, video in zip(uris, limas.lookup_videos(uris)):
         if video:
-            video['stats'] = VideoStats.summary_for_video(videoUri)
+            video['stats'] = summaries[videoUri]
             videos.append(video)
     return videos
 
@@ -241,16 +317,22 @@ def recent_search_results(request):
     
     history = [{'date': q['date'], 
         'query': q['data'], 'id': q['_id']} for q in queries]
-    for result in history:
-        try:
-            assets = fetch_topn_assets(result['id'], 6)
-        except:
-            # We skip over any queries causing exceptions so that we still
-            # have some results to display even if was is a query that caused 
-            # a HTTP 500 in LIMAS due to some problem there.
-            continue
-        else:
-            result['topn'] = assets
+    
+    # Top results are snapshotted on the query, and only refetched when the
+    # snapshot is out of date
+    generation = results_generation()
+    for query, result in zip(queries, history):
+        topn = query.get('topn')
+        if topn is None or topn.get('generation') != generation:
+            try:
+                assets = fetch_topn_assets(query, TOPN_SIZE)
+            except:
+                # We skip over any queries causing exceptions so that we still
+                # have some results to display even if was is a query that 
+                # caused a HTTP 500 in LIMAS due to some problem there.
+                continue
+            topn = save_topn_snapshot(query[MONGO_ID], assets, generation)
+        result['topn'] = topn['assets']
     return filter(lambda x: 'topn' in x, history)
     
 ##    
@@ -264,11 +346,13 @@ def list_favorites(request):
         .filter(user=request.user, favorite=True) \
         .values_list('videoUri') \
         .distinct()
+    uris = [videoUri for (videoUri, ) in recent]
+    summaries = VideoStats.summaries_for_videos(uris)
     videos = []
-    for (videoUri, ) in recent:
-        video = limas.lookup_video(videoUri)
-        video['stats'] = VideoStats.summary_for_video(videoUri)
-        videos.append(video)
+    for videoUri, video in zip(uris, limas.lookup_videos(uris)):
+        if video:
+            video['stats'] = summaries[videoUri]
+            videos.append(video)
     return videos
 
 ##    
@@ -284,30 +368,19 @@ def download(request, video_uri):
 @api.endpoint(pattern="^favorite/(?P<video_uri>.*?)/$", method='GET')
 def favorite(request, video_uri):
     video_uri = Limas.fix_uri(video_uri)
-    stats, created = VideoStats.objects.get_or_create(
-        user=request.user, videoUri=video_uri)
-    stats.favorite = True
-    stats.save()
+    VideoStats.set_flags(request.user, video_uri, favorite=True)
     return VideoStats.summary_for_video(video_uri)
     
 @api.endpoint(pattern="^like/(?P<video_uri>.*?)/$", method='GET')
 def like(request, video_uri):
     video_uri = Limas.fix_uri(video_uri)
-    stats, created = VideoStats.objects.get_or_create(
-        user=request.user, videoUri=video_uri)
-    stats.likes = True
-    stats.dislikes = False
-    stats.save()
+    VideoStats.set_flags(request.user, video_uri, likes=True, dislikes=False)
     return VideoStats.summary_for_video(video_uri)
 
 @api.endpoint(pattern="^dislike/(?P<video_uri>.*?)/$", method='GET')
 def dislike(request, video_uri):
     video_uri = Limas.fix_uri(video_uri)
-    stats, created = VideoStats.objects.get_or_create(
-        user=request.user, videoUri=video_uri)
-    stats.likes = False
-    stats.dislikes = True
-    stats.save()
+    VideoStats.set_flags(request.user, video_uri, likes=False, dislikes=True)
     return VideoStats.summary_for_video(video_uri)
    
 ##    
@@ -393,11 +466,11 @@ def popular_videos(request, type):
     def fetch_popular_videos(request, order_by):
         results = VideoStats.fetch_popular(order_by, first, count)
         uris = [result['videoUri'] for result in results]
+        summaries = VideoStats.summaries_for_videos(uris)
         videos = []
-        for videoUri in uris:
-            video = limas.lookup_video(videoUri)
+        for videoUri, video in zip(uris, limas.lookup_videos(uris)):
             if video:
-                video['stats'] = VideoStats.summary_for_video(videoUri)
+                video['stats'] = summaries[videoUri]
                 videos.append(video)
         return videos
     
@@ -519,8 +592,9 @@ def system_info(request):
         ffmpeg_version = 'unknown'
     
     try:
-        limas_version_info = format_version(limas.get_version_info())
-        limas_service_info = limas.get_service_info()
+        version_info, limas_service_info = limas.fan_out.map(
+            [limas.get_version_info, limas.get_service_info])
+        limas_version_info = format_version(version_info)
     except (IOError, OSError), e:
         limas_version_info = 'Unknown (connection error: {})'.format(str(e))
         limas_service_info = []
@@ -546,12 +620,36 @@ def system_info(request):
         'limasURL': settings.SERVICE_URL,
         'limasCacheEnabled': settings.LIMAS_CACHE_ENABLED,
         'limasVersionInfo': limas_version_info,
+        'limasRpcStats': limas.rpc_stats.summary(),
+        'limasRpcStatsSince': limas.rpc_stats.started,
+        'limasSlowCalls': list(limas.rpc_stats.slow_calls),
         'limasServiceInfo': limas_service_info,
         'ffmpegVersion': ffmpeg_version,
         'celeryVersion': celery.__version__,
         'users': users
     }
     
+@api.endpoint('system/cache', method='GET')
+def system_cache(request):
+    caches = dict((info[MONGO_ID], info) for info in db.cacheinfo.find())
+    metrics = CachedLimasService.metrics.report()
+    for totals in metrics:
+        info = caches.get(totals['cache'], {})
+        totals['evicted'] = info.get('evicted', 0)
+        totals['cleared'] = info.get('age')
+    local_cache = CachedLimasService.local_cache
+    if local_cache is not None:
+        local_cache = {
+            'entries': len(local_cache), 
+            'size': local_cache.size, 
+            'maxEntries': local_cache.max_entries,
+            'maxSize': local_cache.max_bytes}
+    return {
+        'enabled': settings.LIMAS_CACHE_ENABLED,
+        'caches': metrics,
+        'localCache': local_cache
+    }
+    
 @api.endpoint('system/log', method='GET')
 def system_log(request):
     with open(settings.LOG_FILE, 'r') as f:
@@ -563,14 +661,7 @@ def system_log(request):
 ##
 @api.endpoint('recommendations', method='GET')
 def get_recommendations(request):
-    # TODO: Get recommendations from Limas or implement basic rec sys
-    # For now, we just randomly recommend from cached videos
-    import random
-    videos = db.videos.find()
-    n_vids = videos.count()
-    n_recs = min(n_vids, 10)
-    indices = [random.randrange(0, n_vids) for i in xrange(n_recs)]
-    indices.sort()
-    recommendations = [videos[i] for i in indices]
-    return recommendations
+    # Built offline by the build_recommendations task
+    uris = recommender.recommended_videos(request.user, 10)
+    return filter(None, Limas().lookup_videos(uris))
     
\ No newline at end of file
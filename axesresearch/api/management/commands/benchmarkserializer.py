@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from axesresearch.api.backend import Limas, CachedLimasService
+from axesresearch.api.models import VideoStats
+from axesresearch.api.serializer import SerializedObject, serialize, \
+    json_backend
+
+import json
+import time
+
+MONGO_ID = '_id'
+
+class Command(BaseCommand):
+    help = "Compare the speed of the API serializer with the two pass one " \
+        "on the results of recent searches"
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--queries', type='int', default=10,
+            help='Number of recent searches to use as payloads'),
+        make_option('--repeat', type='int', default=20,
+            help='Number of times to serialize each payload'),
+    )
+    
+    def handle(self, *args, **options):
+        payloads = self.load_payloads(options['queries'])
+        if not payloads:
+            raise CommandError('No search results to benchmark with')
+        
+        def two_pass(obj):
+            return json.dumps(SerializedObject(obj).to_python())
+        
+        for payload in payloads:
+            if json.loads(two_pass(payload)) != json.loads(serialize(payload)):
+                raise CommandError('Serializers disagree on a payload')
+        
+        size = sum(len(serialize(payload)) for payload in payloads)
+        self.stdout.write('{} payloads, {:.0f} KB, {} repeats, backend {}'
+            .format(len(payloads), size / 1024.0, options['repeat'],
+                json_backend.__name__))
+        timings = {}
+        for name, func in (('two pass', two_pass), ('single pass', serialize)):
+            started = time.time()
+            for i in xrange(options['repeat']):
+                for payload in payloads:
+                    func(payload)
+            elapsed = time.time() - started
+            timings[name] = elapsed
+            self.stdout.write('  {:<12} {:>9.2f} ms per payload'.format(
+                name, 1000 * elapsed / (options['repeat'] * len(payloads))))
+        self.stdout.write('  speedup      {:>9.2f}x'.format(
+            timings['two pass'] / timings['single pass']))
+    
+    def load_payloads(self, count):
+        """
+        Search results for recent queries as the search endpoint returns
+        them, with the video statistics attached
+        """
+        limas = Limas()
+        queries = CachedLimasService.db.queries.find() \
+            .sort('date', -1).limit(count)
+        payloads = []
+        for query in queries:
+            try:
+                results = limas.search(query)
+            except Exception, e:
+                self.stderr.write('Skipping query {}: {}'.format(
+                    query[MONGO_ID], e))
+                continue
+            if results is None:
+                continue
+            summaries = VideoStats.summaries_for_videos(
+                results.get('videos', {}).keys())
+            for uri, video in results.get('videos', {}).iteritems():
+                video['stats'] = summaries[uri]
+            payloads.append(results)
+        return payloads
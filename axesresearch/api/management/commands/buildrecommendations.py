@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from axesresearch.api.recommender import build_recommendations
+
+class Command(BaseCommand):
+    help = "Rebuild the co-view video recommendations from the video stats"
+    
+    def handle(self, *args, **options):
+        videos, users = build_recommendations()
+        self.stdout.write('Built recommendations for {} videos and {} users'
+            .format(videos, users))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from axesresearch.api.backend import CachedLimasService
+
+class Command(BaseCommand):
+    help = "Show hit rates, timings, and document sizes for the limas caches"
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', default=False,
+            help='Reset the metrics after showing them'),
+    )
+    
+    def handle(self, *args, **options):
+        metrics = CachedLimasService.metrics
+        
+        def format(value, pattern='{:.1f}'):
+            return '-' if value is None else pattern.format(value)
+        
+        self.stdout.write('{:<16} {:>9} {:>9} {:>9} {:>7} {:>9} {:>9} {:>9}'
+            .format('cache', 'hits', 'stale', 'misses', 'rate', 
+                'read ms', 'fill ms', 'mean KB'))
+        for totals in metrics.report():
+            self.stdout.write(
+                '{:<16} {:>9.0f} {:>9.0f} {:>9.0f} {:>7} {:>9} {:>9} {:>9}'
+                .format(totals['cache'], 
+                    totals.get('hits', 0), 
+                    totals.get('stale', 0), 
+                    totals.get('misses', 0),
+                    format(totals['hitRate'], '{:.1%}'),
+                    format(totals['readMeanMillis']),
+                    format(totals['fillMeanMillis']),
+                    format(totals['meanSize'] and totals['meanSize'] / 1024)))
+            sizes = totals.get('sizes', {})
+            if sizes:
+                buckets = [label for limit, label in metrics.size_buckets]
+                buckets.append('larger')
+                self.stdout.write('{:<16} sizes: {}'.format('', ', '.join(
+                    '<={}: {:.0f}'.format(label, sizes[label]) 
+                    for label in buckets if label in sizes)))
+        if options['reset']:
+            metrics.reset()
+            self.stdout.write('Metrics reset')
@@ -10,3 +10,4 @@ class Command(BaseCommand):
         self.stdout.write('Cleared caches:')
         for cache in caches:
             self.stdout.write("  " + cache)
+        self.stdout.write('Outdated entries are removed by sweepcaches')
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from axesresearch.api.backend import CachedLimasService
+
+class Command(BaseCommand):
+    help = "Evict least recently used entries from oversized limas caches"
+    
+    def handle(self, *args, **options):
+        limas = CachedLimasService()
+        evicted = limas.evict_caches()
+        self.stdout.write('Evicted entries:')
+        for cache, count in sorted(evicted.iteritems()):
+            self.stdout.write("  {}: {}".format(cache, count))
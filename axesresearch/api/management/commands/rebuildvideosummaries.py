@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, Max
+from axesresearch.api.models import VideoStats, VideoSummary
+
+class Command(BaseCommand):
+    help = "Rebuild the per video stats summaries from the per user stats"
+    
+    def handle(self, *args, **options):
+        totals = VideoStats.objects \
+            .values('videoUri') \
+            .annotate(
+                favorites=Sum('favorite'),
+                likes=Sum('likes'),
+                dislikes=Sum('dislikes'),
+                views=Sum('views'),
+                downloads=Sum('downloads'),
+                lastViewed=Max('lastViewed'))
+        summaries = [VideoSummary(**total) for total in totals]
+        with transaction.atomic():
+            VideoSummary.objects.all().delete()
+            VideoSummary.objects.bulk_create(summaries, batch_size=500)
+        self.stdout.write('Rebuilt summaries for {} videos'.format(
+            len(summaries)))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from axesresearch.api.backend import CachedLimasService
+
+class Command(BaseCommand):
+    help = "Remove outdated entries from the mongodb caches for the limas backend"
+    
+    def handle(self, *args, **options):
+        limas = CachedLimasService()
+        removed = limas.sweep_caches()
+        self.stdout.write('Removed outdated entries:')
+        for cache, count in sorted(removed.iteritems()):
+            self.stdout.write("  {}: {}".format(cache, count))
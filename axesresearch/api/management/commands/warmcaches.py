@@ -0,0 +1,175 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+from axesresearch.api.backend import CachedLimasService, MONGO_ID
+from axesresearch.api.models import VideoStats
+
+import threading
+import logging
+import time
+
+log = logging.getLogger('axesresearch')
+
+class RateLimiter(object):
+    """
+    Thread safe token bucket allowing on average rate calls per second
+    """
+    
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, 
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class WarmingLimasService(CachedLimasService):
+    """
+    Cached limas service that rate limits the requests sent to limas
+    """
+    limiter = None
+    
+    def _fetch(self, func, args, options):
+        # Each fetch of a cache entry (or batch of entries) is one request
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return super(WarmingLimasService, self)._fetch(func, args, options)
+
+class Command(BaseCommand):
+    help = ("Warm the mongodb caches for the limas backend using popular " 
+        "videos, recent queries, and videos in user collections")
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', type='int', default=4,
+            help='Number of concurrent workers'),
+        make_option('--rate', type='float', default=10.0,
+            help='Maximum number of limas requests per second'),
+        make_option('--popular', type='int', default=200,
+            help='Number of most viewed videos to warm'),
+        make_option('--queries', type='int', default=100,
+            help='Number of recent queries to warm'),
+        make_option('--batch', type='int', default=50,
+            help='Number of videos to look up per request'),
+        make_option('--restart', action='store_true', default=False,
+            help='Ignore progress saved by an interrupted run'),
+    )
+    
+    caches = ('results', 'videos', 'segments', 'keyframes', 'transcripts')
+    
+    def handle(self, *args, **options):
+        limas = CachedLimasService()
+        self.db = limas.db
+        self.local = threading.local()
+        WarmingLimasService.limiter = RateLimiter(options['rate'])
+        
+        # Progress is kept per cache generation, so a run is resumed after
+        # an interruption, but not after the caches have been invalidated
+        self.run = max(limas.cache_generation(cache) for cache in self.caches)
+        if options['restart']:
+            self.db.cachewarming.remove()
+        else:
+            self.db.cachewarming.remove({'run': {'$ne': self.run}})
+        done = set(task[MONGO_ID] for task in self.db.cachewarming.find())
+            
+        tasks = self.plan(options, done)
+        if not tasks:
+            self.stdout.write('Caches are already warm')
+            return
+        
+        self.stdout.write('Warming caches: {} tasks, {} workers, {}/s'.format(
+            len(tasks), options['concurrency'], options['rate']))
+        pool = ThreadPool(options['concurrency'])
+        errors = 0
+        started = time.time()
+        try:
+            results = pool.imap_unordered(self.execute, tasks)
+            for i, ok in enumerate(results, 1):
+                if not ok:
+                    errors += 1
+                if i % 10 == 0 or i == len(tasks):
+                    self.stdout.write('  {}/{} tasks ({} errors, {:.0f}s)'.format(
+                        i, len(tasks), errors, time.time() - started))
+        finally:
+            pool.terminate()
+        self.stdout.write('Done')
+        
+    def plan(self, options, done):
+        """
+        List the warming tasks still to do as (name, keys) pairs
+        """
+        tasks = []
+        
+        # Recent queries: warms results, segments, videos, and the assets 
+        # shown in the recent searches list
+        queries = self.db.queries.find({}, [MONGO_ID]) \
+            .sort('date', -1).limit(options['queries'])
+        for query in queries:
+            key = u'search:{}'.format(query[MONGO_ID])
+            if key not in done:
+                tasks.append(('search', [query[MONGO_ID]]))
+        
+        # Popular videos and videos in collections
+        uris = []
+        popular = VideoStats.fetch_popular('views', 0, options['popular'])
+        uris.extend(result['videoUri'] for result in popular)
+        for collection in self.db.collections.find({}, ['videos']):
+            for video in collection.get('videos', []):
+                uri = video.get('uri') or video.get('videoUri')
+                if uri:
+                    uris.append(uri)
+        uris = sorted(set(map(CachedLimasService.fix_uri, uris)))
+        
+        for name in ('videos', 'assets'):
+            pending = [video_uri for video_uri in uris 
+                if u'{}:{}'.format(name, video_uri) not in done]
+            for i in xrange(0, len(pending), options['batch']):
+                tasks.append((name, pending[i:i + options['batch']]))
+        for name in ('keyframes', 'transcripts'):
+            for uri in uris:
+                if u'{}:{}'.format(name, uri) not in done:
+                    tasks.append((name, [uri]))
+        return tasks
+    
+    @property
+    def limas(self):
+        # The rpc proxy is not thread safe: use one service per worker
+        if not hasattr(self.local, 'limas'):
+            self.local.limas = WarmingLimasService()
+        return self.local.limas
+        
+    def execute(self, task):
+        name, keys = task
+        limas = self.limas
+        try:
+            if name == 'search':
+                query = self.db.queries.find_one({MONGO_ID: keys[0]})
+                results = limas.search(query)
+                uris = [result['uri'] for result in results['ranking'][:6]]
+                limas.lookup_assets(uris)
+            elif name == 'videos':
+                limas.lookup_videos(keys)
+            elif name == 'assets':
+                limas.lookup_assets(keys)
+            elif name == 'keyframes':
+                limas.get_keyframes(keys[0])
+            elif name == 'transcripts':
+                limas.get_transcript(keys[0])
+        except Exception, e:
+            log.error('error warming %s %s: %s', name, keys, e)
+            return False
+        for key in keys:
+            self.db.cachewarming.save({
+                MONGO_ID: u'{}:{}'.format(name, key), 'run': self.run})
+        return True
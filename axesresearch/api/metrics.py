@@ -0,0 +1,194 @@
+# Author: Kevin McGuinness <kevin.mcguinness@dcu.ie>
+#
+"""
+Instrumentation for the LIMAS service and response caches
+"""
+import threading
+import logging
+import atexit
+import time
+
+from collections import defaultdict, deque
+from datetime import datetime
+
+log = logging.getLogger('axesresearch')
+slow_call_log = logging.getLogger('axesresearch.slowcalls')
+
+MONGO_ID = '_id'
+
+class CacheMetrics(object):
+    """
+    Counters, timings, and document size histograms for a set of caches.
+    
+    Values are accumulated in memory and added to per cache totals in a 
+    mongodb collection at most once every ``flush_interval`` seconds, so 
+    that the totals cover all worker processes.
+    """
+    
+    # Upper bounds of the document size histogram buckets in bytes
+    size_buckets = (
+        (1 << 10, '1KB'), 
+        (4 << 10, '4KB'), 
+        (16 << 10, '16KB'), 
+        (64 << 10, '64KB'), 
+        (256 << 10, '256KB'), 
+        (1 << 20, '1MB'), 
+        (4 << 20, '4MB'))
+    
+    def __init__(self, collection, flush_interval):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self._values = defaultdict(lambda: defaultdict(float))
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+        
+    def increment(self, cache, name, value=1):
+        with self._lock:
+            self._values[cache][name] += value
+        self.flush_if_due()
+            
+    def timing(self, cache, name, seconds):
+        with self._lock:
+            self._values[cache][name + 'Time'] += seconds
+            self._values[cache][name + 'Count'] += 1
+        self.flush_if_due()
+        
+    def size(self, cache, size):
+        for limit, label in self.size_buckets:
+            if size <= limit:
+                break
+        else:
+            label = 'larger'
+        with self._lock:
+            self._values[cache]['sizes.' + label] += 1
+            self._values[cache]['bytes'] += size
+        self.flush_if_due()
+        
+    def flush_if_due(self):
+        if time.time() - self._flushed >= self.flush_interval:
+            self.flush()
+    
+    def flush(self):
+        with self._lock:
+            values, self._values = self._values, defaultdict(
+                lambda: defaultdict(float))
+            self._flushed = time.time()
+        try:
+            for cache, counts in values.iteritems():
+                self.collection.update({MONGO_ID: cache}, 
+                    {'$inc': dict(counts)}, upsert=True)
+        except Exception, e:
+            log.error('unable to flush cache metrics: %s', e)
+            
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+        self.collection.remove()
+        
+    def report(self):
+        """
+        Totals for all processes, with hit rates and mean timings
+        """
+        self.flush()
+        report = []
+        for totals in self.collection.find().sort(MONGO_ID):
+            hits = totals.get('hits', 0)
+            stale = totals.get('stale', 0)
+            misses = totals.get('misses', 0)
+            requests = hits + stale + misses
+            totals['cache'] = totals.pop(MONGO_ID)
+            totals['requests'] = requests
+            totals['hitRate'] = (hits + stale) / requests if requests else None
+            for name in ('read', 'fill'):
+                count = totals.get(name + 'Count', 0)
+                total = totals.get(name + 'Time', 0)
+                mean = 1000.0 * total / count if count else None
+                totals[name + 'MeanMillis'] = mean
+            fills = sum(totals.get('sizes', {}).values())
+            totals['meanSize'] = totals.get('bytes', 0) / fills if fills else None
+            report.append(totals)
+        return report
+
+class RpcStats(object):
+    """
+    Latency, payload size, and error statistics for each RPC method.
+    
+    Percentiles are computed over the last ``window`` calls of each method 
+    in this process. Calls taking ``slow_threshold`` seconds or more are 
+    written to the slow call log and the last ``slow_calls`` of them are 
+    kept for display.
+    """
+    
+    percentiles = (50, 90, 99)
+    
+    def __init__(self, window, slow_threshold, slow_calls):
+        self.window = window
+        self.slow_threshold = slow_threshold
+        self.slow_calls = deque(maxlen=slow_calls)
+        self.started = datetime.now()
+        self._methods = {}
+        self._lock = threading.Lock()
+        
+    def record(self, method, seconds, args, request_size, response_size, 
+        error=None):
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = {
+                    'calls': 0, 
+                    'errors': 0, 
+                    'time': 0.0,
+                    'requestBytes': 0, 
+                    'responseBytes': 0,
+                    'latencies': deque(maxlen=self.window)
+                }
+            stats['calls'] += 1
+            stats['time'] += seconds
+            stats['requestBytes'] += request_size
+            stats['responseBytes'] += response_size
+            stats['latencies'].append(seconds)
+            if error is not None:
+                stats['errors'] += 1
+        if seconds >= self.slow_threshold:
+            arguments = repr(args)[:500]
+            slow_call_log.warning(
+                '%s took %.3fs request: %d bytes response: %d bytes '
+                'error: %r args: %s', method, seconds, request_size, 
+                response_size, error, arguments)
+            self.slow_calls.appendleft({
+                'method': method, 
+                'time': datetime.now(), 
+                'millis': 1000 * seconds,
+                'error': repr(error) if error is not None else None,
+                'args': arguments})
+                
+    def summary(self):
+        """
+        Statistics for each method, ordered by total time spent
+        """
+        with self._lock:
+            methods = [(method, dict(stats, latencies=sorted(
+                stats['latencies']))) for method, stats in 
+                self._methods.iteritems()]
+        summary = []
+        for method, stats in methods:
+            latencies = stats.pop('latencies')
+            calls = stats['calls']
+            stats['method'] = method
+            stats['meanMillis'] = 1000 * stats['time'] / calls
+            stats['maxMillis'] = 1000 * latencies[-1]
+            stats['meanRequestBytes'] = stats['requestBytes'] / calls
+            stats['meanResponseBytes'] = stats['responseBytes'] / calls
+            for p in self.percentiles:
+                index = min(len(latencies) - 1, len(latencies) * p // 100)
+                stats['p{}Millis'.format(p)] = 1000 * latencies[index]
+            summary.append(stats)
+        summary.sort(key=lambda stats: stats['time'], reverse=True)
+        return summary
+        
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+            self.slow_calls.clear()
+            self.started = datetime.now()
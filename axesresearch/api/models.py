@@ -1,9 +1,70 @@
 # Author: Kevin McGuinness <kevin.mcguinness@dcu.ie>
 #
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q
+from django.conf import settings
+from counters import CounterBuffer
 from datetime import datetime
 
+class VideoSummary(models.Model):
+    """
+    Totals of the stats of each video over all users. Kept up to date as 
+    the stats change, so that they can be read (and ranked by popularity) 
+    without aggregating VideoStats. Can be rebuilt from VideoStats with the
+    rebuildvideosummaries command.
+    """
+    videoUri = models.CharField(max_length=50, unique=True)
+    favorites = models.IntegerField(default=0, db_index=True)
+    likes = models.IntegerField(default=0, db_index=True)
+    dislikes = models.IntegerField(default=0, db_index=True)
+    views = models.IntegerField(default=0, db_index=True)
+    downloads = models.IntegerField(default=0, db_index=True)
+    lastViewed = models.DateTimeField(blank=True, null=True)
+    
+    totals = ('favorites', 'likes', 'dislikes', 'views', 'downloads')
+    
+    @classmethod
+    def add(cls, video_uri, last_viewed=None, **deltas):
+        """
+        Atomically add to the totals of a video, creating its summary if it
+        does not exist yet. The last view time is only moved forward.
+        """
+        updates = dict((name, F(name) + delta) 
+            for name, delta in deltas.iteritems() if delta)
+        if not updates and last_viewed is None:
+            return
+        if cls._update(video_uri, updates, last_viewed):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(videoUri=video_uri, 
+                    lastViewed=last_viewed, **deltas)
+        except IntegrityError:
+            # Created concurrently
+            cls._update(video_uri, updates, last_viewed)
+            
+    @classmethod
+    def _update(cls, video_uri, updates, last_viewed):
+        """
+        Update the summary of a video if there is one, keeping the later of 
+        its last view time and last_viewed. Returns whether it exists.
+        """
+        summaries = cls.objects.filter(videoUri=video_uri)
+        if updates:
+            exists = summaries.update(**updates) > 0
+        else:
+            exists = summaries.exists()
+        if exists and last_viewed is not None:
+            summaries.filter(Q(lastViewed__isnull=True) | 
+                Q(lastViewed__lt=last_viewed)).update(lastViewed=last_viewed)
+        return exists
+            
+    def as_dict(self):
+        summary = dict((name, getattr(self, name)) for name in self.totals)
+        summary['lastViewed'] = self.lastViewed
+        return summary
+
 class VideoStats(models.Model):
     user = models.ForeignKey(User, related_name="stats")
     videoUri = models.CharField(max_length=50)
@@ -16,43 +77,81 @@ class VideoStats(models.Model):
     
     @classmethod
     def summary_for_video(cls, video_uri):
-        from django.db.models import Count, Sum, Max
-        stats = cls.objects.filter(videoUri=video_uri)
-        if stats.count() > 0:
-            return stats.aggregate(
-                favorites=Sum('favorite'),
-                likes=Sum('likes'),
-                dislikes=Sum('dislikes'),
-                views=Sum('views'),
-                downloads=Sum('downloads'),
-                lastViewed=Max('lastViewed'))
-        return {
-            'favorites': 0, 
-            'likes': 0, 
-            'dislikes': 0, 
-            'views': 0, 
-            'downloads': 0,
-            'lastViewed': None
-        }
+        return cls.summaries_for_videos([video_uri])[video_uri]
+        
+    @classmethod
+    def summaries_for_videos(cls, video_uris, batch_size=500):
+        """
+        Fetch the summaries of several videos using one query (per 
+        batch_size videos). Returns a dict mapping each URI to its summary,
+        with zero counts for videos that have no stats.
+        """
+        summaries = dict((uri, VideoSummary(videoUri=uri).as_dict()) 
+            for uri in video_uris)
+        uris = list(summaries)
+        for i in xrange(0, len(uris), batch_size):
+            for summary in VideoSummary.objects.filter(
+                videoUri__in=uris[i:i + batch_size]):
+                summaries[summary.videoUri] = summary.as_dict()
+        return summaries
     
     @classmethod 
     def increment_view_count(cls, user, video_uri):
-        stats, created = cls.objects.get_or_create(user=user, videoUri=video_uri)
-        stats.views += 1
-        stats.lastViewed = datetime.now()
-        stats.save()
+        counters.add((user.pk, video_uri), {'views': 1}, 
+            {'lastViewed': datetime.now()})
         
     @classmethod
     def increment_download_count(cls, user, video_uri):
+        counters.add((user.pk, video_uri), {'downloads': 1})
+        
+    @classmethod
+    def flush_counts(cls, pending):
+        """
+        Write buffered view and download counts (see counters.CounterBuffer)
+        in a single transaction
+        """
+        with transaction.atomic():
+            for (user_id, video_uri), (counts, latest) in pending.iteritems():
+                stats, created = cls.objects.get_or_create(
+                    user_id=user_id, videoUri=video_uri)
+                updates = dict((name, F(name) + count) 
+                    for name, count in counts.iteritems())
+                updates.update(latest)
+                cls.objects.filter(pk=stats.pk).update(**updates)
+                VideoSummary.add(video_uri, 
+                    last_viewed=latest.get('lastViewed'), **counts)
+        
+    # Summary totals counting the users with each flag set
+    flag_totals = {
+        'favorite': 'favorites', 
+        'likes': 'likes', 
+        'dislikes': 'dislikes'}
+        
+    @classmethod
+    def set_flags(cls, user, video_uri, **flags):
+        """
+        Set the favorite, likes, or dislikes flags of a user for a video, 
+        adjusting the video summary for the flags that actually changed
+        """
         stats, created = cls.objects.get_or_create(user=user, videoUri=video_uri)
-        stats.downloads += 1
-        stats.save()
+        deltas = {}
+        for name, value in flags.iteritems():
+            # Compare and set, so that concurrent requests only count once
+            changed = cls.objects.filter(pk=stats.pk, **{name: not value}) \
+                .update(**{name: value})
+            if changed:
+                deltas[cls.flag_totals[name]] = 1 if value else -1
+        VideoSummary.add(video_uri, **deltas)
         
     @classmethod
     def fetch_popular(cls, order_by, first=0, count=None):
-        from django.db.models import Sum
-        results = cls.objects.values('videoUri') \
-            .annotate(amount=Sum(order_by)) \
-            .order_by('-amount')
+        total = cls.flag_totals.get(order_by, order_by)
+        results = VideoSummary.objects \
+            .extra(select={'amount': total}) \
+            .values('videoUri', 'amount') \
+            .order_by('-' + total)
         return results[first:count]
-     
\ No newline at end of file
+
+# View and download counts waiting to be written
+counters = CounterBuffer(VideoStats.flush_counts, 
+    settings.VIDEO_STATS_FLUSH_INTERVAL, settings.VIDEO_STATS_MAX_PENDING)
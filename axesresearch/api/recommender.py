@@ -0,0 +1,176 @@
+# Author: Kevin McGuinness <kevin.mcguinness@dcu.ie>
+#
+"""
+Item to item co-view recommendations.
+
+Videos are related by how many users engaged (viewed, liked, or favorited)
+with both of them. The recommendations are built offline from VideoStats
+by the buildrecommendations command (or celery task), and stored in mongodb:
+
+    similarvideos: {_id: videoUri, videos: [videoUri], scores: [score]}
+        The most similar videos to each video
+
+    recommendations: {_id: user id, videos: [videoUri], scores: [score]}
+        The top recommendations for each user, excluding videos they have
+        already engaged with or disliked
+
+so that serving the recommendations for a user is a single read by _id.
+"""
+import logging
+import pymongo
+import time
+
+from django.conf import settings
+from django.db.models import Q
+from models import VideoStats
+
+MONGO_ID = '_id'
+
+log = logging.getLogger(__name__)
+
+mongo_client = pymongo.MongoClient()
+db = mongo_client[settings.DATABASE_NAME]
+
+def engagement_weight(views, likes, favorite):
+    weights = settings.RECOMMENDATION_WEIGHTS
+    return ((weights['views'] if views else 0) +
+        (weights['likes'] if likes else 0) +
+        (weights['favorite'] if favorite else 0))
+
+def top_n(matrix, row, n):
+    """
+    Column indices and values of the n largest entries in a row of a CSR
+    matrix, largest first
+    """
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    values = matrix.data[start:end]
+    if len(values) > n:
+        order = values.argpartition(-n)[-n:]
+    else:
+        order = values.argsort()
+    order = order[values[order].argsort()[::-1]]
+    return matrix.indices[start:end][order], values[order]
+
+def build_recommendations(max_similar=None, max_recommendations=None):
+    """
+    Rebuild the similar videos and per user recommendations from VideoStats.
+    Returns the number of videos and users that they were built for.
+    """
+    # Only needed here: the web processes do not depend on numpy and scipy
+    import numpy as np
+    from scipy import sparse
+
+    if max_similar is None:
+        max_similar = settings.RECOMMENDATION_MAX_SIMILAR
+    if max_recommendations is None:
+        max_recommendations = settings.RECOMMENDATIONS_PER_USER
+    started = time.time()
+
+    # User x video engagement matrix, and the videos each user disliked
+    stats = VideoStats.objects \
+        .filter(Q(views__gt=0) | Q(likes=True) | Q(favorite=True) |
+            Q(dislikes=True)) \
+        .values_list('user_id', 'videoUri', 'views', 'likes', 'favorite',
+            'dislikes')
+    users = {}
+    videos = {}
+    rows, cols, weights = [], [], []
+    disliked = []
+    for user_id, uri, views, likes, favorite, dislikes in stats.iterator():
+        row = users.setdefault(user_id, len(users))
+        col = videos.setdefault(uri, len(videos))
+        if dislikes:
+            disliked.append((row, col))
+        weight = engagement_weight(views, likes, favorite)
+        if weight and not dislikes:
+            rows.append(row)
+            cols.append(col)
+            weights.append(weight)
+    engagement = sparse.csr_matrix(
+        (np.array(weights, dtype=np.float32), (rows, cols)),
+        shape=(len(users), len(videos)))
+
+    # Cosine similarity of the videos over the users who engaged with them,
+    # keeping the max_similar most similar videos to each
+    engaged = engagement.copy()
+    engaged.data[:] = 1
+    coviews = (engaged.T * engaged).tocsr()
+    coviews.setdiag(0)
+    coviews.eliminate_zeros()
+    norms = np.sqrt(np.asarray(engaged.sum(axis=0), dtype=np.float32).ravel())
+    norms[norms == 0] = 1
+    scale = sparse.diags(1 / norms, 0)
+    similarity = (scale * coviews * scale).tocsr()
+    rows, cols, scores = [], [], []
+    for row in xrange(similarity.shape[0]):
+        indices, values = top_n(similarity, row, max_similar)
+        rows.extend([row] * len(indices))
+        cols.extend(indices)
+        scores.extend(values)
+    similarity = sparse.csr_matrix((scores, (rows, cols)),
+        shape=similarity.shape)
+
+    # Score every video for every user in one product, then drop the videos
+    # a user has already engaged with or disliked
+    seen = engaged + sparse.csr_matrix(
+        (np.ones(len(disliked)), zip(*disliked) or ([], [])),
+        shape=engaged.shape)
+    recommended = engagement * similarity
+    recommended = (recommended - recommended.multiply(seen > 0)).tocsr()
+    recommended.eliminate_zeros()
+
+    uris = [None] * len(videos)
+    for uri, col in videos.iteritems():
+        uris[col] = uri
+    generated = time.time()
+
+    def documents(matrix, keys, n):
+        for key, row in keys.iteritems():
+            indices, values = top_n(matrix, row, n)
+            if len(indices):
+                yield {
+                    MONGO_ID: key,
+                    'videos': [uris[i] for i in indices],
+                    'scores': [float(v) for v in values],
+                    'generated': generated}
+
+    similar_count = save_documents(db.similarvideos,
+        documents(similarity, videos, max_similar), generated)
+    user_count = save_documents(db.recommendations,
+        documents(recommended, users, max_recommendations), generated)
+    log.info('Built recommendations for %d videos and %d users in %.1fs',
+        similar_count, user_count, time.time() - started)
+    return similar_count, user_count
+
+def save_documents(collection, documents, generated, batch_size=1000):
+    """
+    Replace the contents of a collection with the given documents, removing
+    the documents from earlier builds once the new ones are written
+    """
+    count = 0
+    bulk = None
+    for document in documents:
+        if bulk is None:
+            bulk = collection.initialize_unordered_bulk_op()
+        bulk.find({MONGO_ID: document[MONGO_ID]}).upsert() \
+            .replace_one(document)
+        count += 1
+        if count % batch_size == 0:
+            bulk.execute()
+            bulk = None
+    if bulk is not None:
+        bulk.execute()
+    collection.remove({'generated': {'$ne': generated}})
+    return count
+
+def recommended_videos(user, count=10):
+    """
+    URIs of the videos recommended to a user. Falls back to the most viewed
+    videos for users without recommendations.
+    """
+    if user.is_authenticated():
+        recommendations = db.recommendations.find_one({MONGO_ID: user.pk})
+        if recommendations is not None:
+            return recommendations['videos'][:count]
+    popular = VideoStats.fetch_popular('views', 0, count)
+    return [result['videoUri'] for result in popular]
@@ -0,0 +1,403 @@
+# Author: Kevin McGuinness <kevin.mcguinness@dcu.ie>
+#
+"""
+JSON RPC transport and proxy helpers for the LIMAS service
+"""
+import jsonrpclib
+import threading
+import httplib
+import select
+import socket
+import logging
+import time
+
+from jsonrpclib.jsonrpc import Transport, SafeTransport, dumps
+from xmlrpclib import ProtocolError
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
+
+log = logging.getLogger('axesresearch')
+
+class DeadlineExceeded(IOError):
+    pass
+
+class FanOut(object):
+    """
+    Runs independent calls concurrently with a shared deadline.
+    
+    The mode is 'gevent' (a greenlet per call), 'threads' (a process-wide 
+    pool of ``size`` threads), or None to make the calls one after another.
+    Calls made from inside a fanned out call are run sequentially, so that 
+    nested fan outs cannot exhaust the thread pool.
+    """
+    
+    def __init__(self, mode, size, timeout):
+        if mode not in ('gevent', 'threads', None):
+            raise ValueError('unknown fan out mode: {}'.format(mode))
+        self.mode = mode
+        self.size = size
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        
+    def map(self, calls):
+        """
+        Call each of the given functions (without arguments), returning a 
+        list of their results. The first exception raised by a call is 
+        re-raised, and DeadlineExceeded is raised if the calls have not all
+        completed within the timeout.
+        """
+        calls = list(calls)
+        if self.mode is None or len(calls) < 2 or getattr(
+            self._local, 'nested', False):
+            return [call() for call in calls]
+        if self.mode == 'gevent':
+            return self._map_gevent(calls)
+        return self._map_threads(calls)
+        
+    def _run(self, call):
+        self._local.nested = True
+        try:
+            return call()
+        finally:
+            self._local.nested = False
+    
+    def _map_gevent(self, calls):
+        import gevent
+        jobs = [gevent.spawn(self._run, call) for call in calls]
+        gevent.joinall(jobs, timeout=self.timeout)
+        if not all(job.ready() for job in jobs):
+            gevent.killall(jobs, block=False)
+            raise DeadlineExceeded(
+                'calls did not complete within {}s'.format(self.timeout))
+        for job in jobs:
+            if not job.successful():
+                raise job.exception
+        return [job.value for job in jobs]
+        
+    def _map_threads(self, calls):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.size)
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        pending = [self._pool.apply_async(self._run, (call,)) 
+            for call in calls]
+        results = []
+        for result in pending:
+            if deadline is None:
+                # get() without a timeout cannot be interrupted
+                timeout = 365 * 24 * 3600
+            else:
+                timeout = max(0, deadline - time.time())
+            try:
+                results.append(result.get(timeout))
+            except TimeoutError:
+                raise DeadlineExceeded(
+                    'calls did not complete within {}s'.format(self.timeout))
+        return results
+
+class ConnectionPool(object):
+    """
+    Process-wide pool of persistent HTTP/1.1 connections.
+    
+    At most ``size`` connections are in use at once; further requests wait
+    for one to be returned. Idle connections are reused most recently used
+    first, and are discarded when they have been idle for more than 
+    ``idle_timeout`` seconds or the server has closed them. Uses threading
+    primitives, so it is safe with both threads and (monkey patched) gevent
+    greenlets.
+    """
+    
+    def __init__(self, size, idle_timeout, timeout=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        
+    def acquire(self, host, secure=False):
+        """
+        Returns a connection to host and whether it was reused
+        """
+        self._slots.acquire()
+        try:
+            key = (host, secure)
+            now = time.time()
+            while True:
+                with self._lock:
+                    idle = self._idle.get(key)
+                    if not idle:
+                        break
+                    connection, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout and self._healthy(
+                    connection):
+                    return connection, True
+                connection.close()
+            if secure:
+                connection = httplib.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(host, timeout=self.timeout)
+            return connection, False
+        except:
+            self._slots.release()
+            raise
+            
+    def release(self, host, connection, secure=False, reusable=True):
+        try:
+            if reusable:
+                with self._lock:
+                    idle = self._idle.setdefault((host, secure), [])
+                    idle.append((connection, time.time()))
+            else:
+                connection.close()
+        finally:
+            self._slots.release()
+            
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, last_used in connections:
+                connection.close()
+            
+    @staticmethod
+    def _healthy(connection):
+        # An idle connection should have nothing to read: if it is readable
+        # the server has closed it (or sent something unexpected)
+        if connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+class PooledTransport(Transport):
+    """
+    JSON RPC transport that sends requests over connections from a 
+    ConnectionPool, retrying once on a fresh connection if a reused one 
+    turns out to have been closed by the server.
+    """
+    
+    def __init__(self, pool, secure=False):
+        Transport.__init__(self)
+        self.pool = pool
+        self.secure = secure
+        
+    def request(self, host, handler, request_body, verbose=0):
+        host, extra_headers, x509 = self.get_host_info(host)
+        for attempt in (0, 1):
+            connection, reused = self.pool.acquire(host, self.secure)
+            reusable = False
+            try:
+                connection.set_debuglevel(verbose)
+                connection.putrequest('POST', handler, 
+                    skip_accept_encoding=True)
+                for header, value in extra_headers or ():
+                    connection.putheader(header, value)
+                connection.putheader('User-Agent', self.user_agent)
+                connection.putheader('Content-Type', 'application/json-rpc')
+                connection.putheader('Content-Length', str(len(request_body)))
+                connection.endheaders(request_body)
+                response = connection.getresponse(buffering=True)
+                data = response.read()
+                reusable = not response.will_close
+            except (socket.error, httplib.HTTPException):
+                if reused and attempt == 0:
+                    continue
+                raise
+            finally:
+                self.pool.release(host, connection, self.secure, reusable)
+            if response.status != 200:
+                raise ProtocolError(host + handler, response.status, 
+                    response.reason, response.msg)
+            return data
+
+class PayloadSizeMixIn(object):
+    """
+    Remembers the request and response sizes of the last call made by 
+    each thread
+    """
+    
+    def request(self, host, handler, request_body, verbose=0):
+        response = super(PayloadSizeMixIn, self).request(
+            host, handler, request_body, verbose)
+        self.sizes.last = (len(request_body), len(response or ''))
+        return response
+
+class SizedTransport(PayloadSizeMixIn, Transport):
+    def __init__(self, *args, **kwargs):
+        Transport.__init__(self, *args, **kwargs)
+        self.sizes = threading.local()
+
+class SizedSafeTransport(PayloadSizeMixIn, SafeTransport):
+    def __init__(self, *args, **kwargs):
+        SafeTransport.__init__(self, *args, **kwargs)
+        self.sizes = threading.local()
+        
+class SizedPooledTransport(PayloadSizeMixIn, PooledTransport):
+    def __init__(self, *args, **kwargs):
+        PooledTransport.__init__(self, *args, **kwargs)
+        self.sizes = threading.local()
+        
+def make_transport(url, pool=None, sized=False):
+    """
+    Returns a transport for the given URL, using connections from pool 
+    if given, and recording payload sizes if sized is True
+    """
+    secure = url.startswith('https:')
+    if pool is not None:
+        transport_type = SizedPooledTransport if sized else PooledTransport
+        return transport_type(pool, secure)
+    if sized:
+        return SizedSafeTransport() if secure else SizedTransport()
+    return SafeTransport() if secure else Transport()
+
+class TimedServer(object):
+    """
+    JSON RPC server proxy that records the latency, payload sizes, and 
+    errors of each call in ``stats`` (see metrics.RpcStats)
+    """
+    
+    def __init__(self, url, stats, pool=None):
+        self._transport = make_transport(url, pool, sized=True)
+        self._service = jsonrpclib.Server(url, transport=self._transport)
+        self._stats = stats
+        
+    def __getattr__(self, name):
+        return self._timed(name, getattr(self._service, name))
+        
+    def _run_request(self, request):
+        # Raw requests (batches) are recorded as 'batch'
+        return self._timed('batch', self._service._run_request)(request)
+        
+    def _timed(self, name, method):
+        sizes = self._transport.sizes
+        stats = self._stats
+        
+        def call(*args):
+            sizes.last = (0, 0)
+            error = None
+            started = time.time()
+            try:
+                return method(*args)
+            except Exception, e:
+                error = e
+                raise
+            finally:
+                request_size, response_size = sizes.last
+                stats.record(name, time.time() - started, args,
+                    request_size, response_size, error)
+        
+        return call
+
+class BatchCall(object):
+    """
+    The pending result of a call made in an RpcBatch
+    """
+    
+    def __init__(self, method, args):
+        self.method = method
+        self.args = args
+        self.done = False
+        self.value = None
+        self.error = None
+        
+    def set(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.done = True
+        
+    @property
+    def result(self):
+        """
+        The value returned by the call, or the error it raised
+        """
+        if not self.done:
+            raise RuntimeError('batch has not been sent')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class RpcBatch(object):
+    """
+    Collects RPC calls and sends them as a single JSON-RPC 2.0 batch when 
+    the context exits::
+    
+        with RpcBatch(server) as batch:
+            a = batch.lookupStat('Genre', 100)
+            b = batch.lookupStat('Keywords', 100)
+        print a.result, b.result
+        
+    Responses are matched to calls by id, and errors are raised as 
+    jsonrpclib.ProtocolError when the result is accessed. If the server 
+    rejects the batch, ``on_rejected`` is called and the calls are sent one
+    at a time instead.
+    """
+    
+    def __init__(self, server, on_rejected=None):
+        self.server = server
+        self.on_rejected = on_rejected
+        self.calls = []
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.send()
+        
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def call(*args):
+            pending = BatchCall(method, args)
+            self.calls.append(pending)
+            return pending
+        return call
+        
+    def send(self):
+        calls, self.calls = self.calls, []
+        if not calls:
+            return
+        if len(calls) == 1:
+            self.send_sequentially(calls)
+            return
+        # Ids are 1-based since jsonrpclib replaces an id of 0 
+        request = '[{}]'.format(','.join(dumps(call.args, call.method, 
+            rpcid=id, version=2.0) for id, call in enumerate(calls, 1)))
+        try:
+            responses = self.server._run_request(request)
+        except (jsonrpclib.ProtocolError, ProtocolError, ValueError), e:
+            responses = e
+        if not isinstance(responses, list):
+            log.warning('limas rejected a batch request: %r', responses)
+            if self.on_rejected is not None:
+                self.on_rejected()
+            self.send_sequentially(calls)
+            return
+        for response in responses:
+            id = response.get('id') if isinstance(response, dict) else None
+            if not isinstance(id, int) or not 0 < id <= len(calls):
+                continue
+            error = response.get('error')
+            if error is not None:
+                error = jsonrpclib.ProtocolError(
+                    (error.get('code'), error.get('message')))
+            calls[id - 1].set(response.get('result'), error)
+        for call in calls:
+            if not call.done:
+                call.set(error=jsonrpclib.ProtocolError(
+                    (-32603, 'no response to {}() in batch'.format(
+                    call.method))))
+    
+    def send_sequentially(self, calls):
+        for call in calls:
+            try:
+                call.set(getattr(self.server, call.method)(*call.args))
+            except jsonrpclib.ProtocolError, e:
+                call.set(error=e)
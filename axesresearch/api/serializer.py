@@ -30,6 +30,14 @@ try:
     has_mongoengine = True
 except ImportError:
     has_mongoengine = False
+    
+try:
+    # Faster C encoder, if installed
+    import simplejson as json_backend
+    backend_options = {'namedtuple_as_object': False}
+except ImportError:
+    json_backend = json
+    backend_options = {}
 
 __all__ = ('serialize',)
 
@@ -90,9 +98,37 @@ class SerializedObject(object):
     def serialize_list(self, obj):
         return [self.serialize(v) for v in obj]
         
+class JSONEncoder(json_backend.JSONEncoder):
+    """
+    Encodes responses in a single pass: values that are not JSON types are
+    converted as they are reached, without copying the rest of the response
+    """
+    
+    def __init__(self, options=None, **kwargs):
+        super(JSONEncoder, self).__init__(**kwargs)
+        self.options = options or {}
+        self.dateformat = self.options.get('dateformat', '%d-%m-%Y')
+        
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.strftime(self.dateformat)
+        elif has_objectid and isinstance(obj, ObjectId):
+            return str(obj)
+        elif has_django and isinstance(obj, Model):
+            return DjangoModelSerializer(obj, **self.options).serialize()
+        elif has_django and isinstance(obj, QuerySet):
+            return DjangoQuerySetSerializer(obj, **self.options).serialize()
+        elif has_mongoengine and isinstance(obj, \
+            mongoengine.document.BaseDocument):
+            return MongoDocumentSerializer(obj, **self.options).serialize()
+        elif has_mongoengine and isinstance(obj, \
+            mongoengine.queryset.QuerySet):
+            return MongoQuerySetSerializer(obj, **self.options).serialize()
+        return super(JSONEncoder, self).default(obj)
+        
 def serialize(obj, **options):
-    py_obj = SerializedObject(obj, **options).to_python()
-    return json.dumps(py_obj)
+    return json_backend.dumps(obj, cls=JSONEncoder, options=options, 
+        **backend_options)
 
 class SerializerList(list):
     def __contains__(self, value):
@@ -1,6 +1,9 @@
 from celery import task
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from backend import CachedLimasService
+
+import recommender
 
 import os, subprocess, time
 
@@ -51,3 +54,22 @@ def ffmpeg_version():
         return '{} not found: {}'.format(ffmpeg, e)
     lines = stderr.split('\n')
     return lines[0]
+
+@task
+def sweep_caches():
+    removed = CachedLimasService().sweep_caches()
+    for cache, count in removed.iteritems():
+        log.info('Removed %d outdated entries from cache %s', count, cache)
+    return removed
+
+@task
+def evict_caches():
+    evicted = CachedLimasService().evict_caches()
+    for cache, count in evicted.iteritems():
+        if count:
+            log.info('Evicted %d entries from cache %s', count, cache)
+    return evicted
+
+@task
+def build_recommendations():
+    return recommender.build_recommendations()
@@ -0,0 +1,147 @@
+# Author: Kevin McGuinness <kevin.mcguinness@dcu.ie>
+#
+"""
+Tests for JSON-RPC batches against a local stand-in for limas
+"""
+import BaseHTTPServer
+import json
+import threading
+import unittest
+import jsonrpclib
+
+from axesresearch.api.rpc import RpcBatch
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers JSON-RPC 2.0 requests for the methods of StandInServer. Batch
+    responses are sent in reverse order.
+    """
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        self.server.requests.append(request)
+        if isinstance(request, list):
+            if self.server.reject_batches:
+                response = self.error(None, -32600, 'Invalid Request')
+            else:
+                response = [self.respond(call) for call in reversed(request)]
+        else:
+            response = self.respond(request)
+        body = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, call):
+        method = getattr(self.server, 'rpc_' + call['method'], None)
+        if method is None:
+            return self.error(call['id'], -32601, 'Method not found')
+        try:
+            result = method(*call.get('params', []))
+        except ValueError, e:
+            return self.error(call['id'], -32000, str(e))
+        return {'jsonrpc': '2.0', 'result': result, 'id': call['id']}
+
+    def error(self, id, code, message):
+        return {'jsonrpc': '2.0', 'id': id,
+            'error': {'code': code, 'message': message}}
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, reject_batches=False):
+        BaseHTTPServer.HTTPServer.__init__(self,
+            ('127.0.0.1', 0), StandInHandler)
+        self.reject_batches = reject_batches
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/json-rpc'.format(self.server_port)
+
+    def rpc_lookupStat(self, key, limit):
+        return [key, limit]
+
+    def rpc_fail(self, message):
+        raise ValueError(message)
+
+class RpcBatchTest(unittest.TestCase):
+
+    reject_batches = False
+
+    def setUp(self):
+        self.server = StandInServer(self.reject_batches)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.proxy = jsonrpclib.Server(self.server.url)
+        self.rejected = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def batch(self):
+        return RpcBatch(self.proxy, lambda: self.rejected.append(True))
+
+    def test_results_are_matched_by_id(self):
+        with self.batch() as batch:
+            calls = [batch.lookupStat('s{}'.format(i), i) for i in range(5)]
+        self.assertEqual([call.result for call in calls],
+            [['s{}'.format(i), i] for i in range(5)])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(self.server.requests[0]), 5)
+        self.assertFalse(self.rejected)
+
+    def test_errors_are_raised_per_call(self):
+        with self.batch() as batch:
+            first = batch.lookupStat('Genre', 10)
+            failed = batch.fail('no such stat')
+            missing = batch.noSuchMethod()
+            last = batch.lookupStat('Keywords', 20)
+        self.assertEqual(first.result, ['Genre', 10])
+        self.assertEqual(last.result, ['Keywords', 20])
+        with self.assertRaises(jsonrpclib.ProtocolError) as raised:
+            failed.result
+        self.assertEqual(raised.exception.args[0], (-32000, 'no such stat'))
+        with self.assertRaises(jsonrpclib.ProtocolError) as raised:
+            missing.result
+        self.assertEqual(raised.exception.args[0][0], -32601)
+
+    def test_single_call_is_not_batched(self):
+        with self.batch() as batch:
+            call = batch.lookupStat('Genre', 10)
+        self.assertEqual(call.result, ['Genre', 10])
+        self.assertIsInstance(self.server.requests[0], dict)
+
+    def test_result_before_sending(self):
+        batch = self.batch()
+        call = batch.lookupStat('Genre', 10)
+        with self.assertRaises(RuntimeError):
+            call.result
+
+class RejectedRpcBatchTest(RpcBatchTest):
+    """
+    The same calls against a server that does not support batches
+    """
+
+    reject_batches = True
+
+    def test_results_are_matched_by_id(self):
+        with self.batch() as batch:
+            calls = [batch.lookupStat('s{}'.format(i), i) for i in range(5)]
+        self.assertEqual([call.result for call in calls],
+            [['s{}'.format(i), i] for i in range(5)])
+        self.assertEqual(self.rejected, [True])
+        self.assertIsInstance(self.server.requests[0], list)
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertTrue(all(isinstance(request, dict)
+            for request in self.server.requests[1:]))
+
+if __name__ == '__main__':
+    unittest.main()
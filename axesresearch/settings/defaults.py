@@ -101,6 +101,7 @@ AUTHENTICATION_BACKENDS = (
 )
 
 LOG_FILE = path.join(ROOT_DIR, 'logs', 'axesresearch.log')
+SLOW_CALL_LOG_FILE = path.join(ROOT_DIR, 'logs', 'slowcalls.log')
 
 LOGGING = {
   'version': 1,
@@ -128,17 +129,41 @@ LOGGING = {
        'formatter': 'verbose',
        'filename': LOG_FILE
      },
+     'slowcalls': {
+       'level':'WARNING',
+       'class':'logging.FileHandler',
+       'formatter': 'verbose',
+       'filename': SLOW_CALL_LOG_FILE
+     },
   },
   'loggers': { 
     'axesresearch': {
       'handlers': ['console', 'file'],
       'level': 'DEBUG',
     },
+    'axesresearch.slowcalls': {
+      'handlers': ['slowcalls'],
+      'level': 'WARNING',
+      'propagate': False,
+    },
   },
 }
 
 DEFAULT_COLLECTION = 'abc'
 
+# View and download counts are buffered in memory and written to the database
+# every VIDEO_STATS_FLUSH_INTERVAL seconds (0 to write them immediately), or
+# sooner once more than VIDEO_STATS_MAX_PENDING videos have pending counts
+VIDEO_STATS_FLUSH_INTERVAL = 10
+VIDEO_STATS_MAX_PENDING = 1000
+
+# Co-view recommendations: how much viewing, liking, and favoriting a video
+# counts towards relating it to other videos, how many similar videos are
+# kept per video, and how many videos are recommended to each user
+RECOMMENDATION_WEIGHTS = {'views': 1, 'likes': 2, 'favorite': 3}
+RECOMMENDATION_MAX_SIMILAR = 50
+RECOMMENDATIONS_PER_USER = 50
+
 DEFAULT_USER_PREFERENCES = {
     'showFeedbackButtons': True,
     'defaultResultView': 'Detailed',
@@ -146,15 +171,126 @@ DEFAULT_USER_PREFERENCES = {
     'resultsPerPage': 50
 }
 
+# Largest page of search results served at once, and how far down the 
+# ranking pages are fetched from limas (results past it are not served)
+SEARCH_MAX_PAGE_SIZE = 200
+LIMAS_SEARCH_MAX_DEPTH = 2000
+
 import djcelery
 djcelery.setup_loader()
 
 BROKER_URL = 'mongodb://localhost:27017/celery_broker'
 CELERY_RESULT_BACKEND = "mongodb"
 
+from datetime import timedelta
+
+CELERYBEAT_SCHEDULE = {
+    'sweep-limas-caches': {
+        'task': 'axesresearch.api.tasks.sweep_caches',
+        'schedule': timedelta(minutes=30),
+    },
+    'evict-limas-caches': {
+        'task': 'axesresearch.api.tasks.evict_caches',
+        'schedule': timedelta(minutes=10),
+    },
+    'build-recommendations': {
+        'task': 'axesresearch.api.tasks.build_recommendations',
+        'schedule': timedelta(hours=6),
+    },
+}
+
 LIMAS_PREPEND_URI_SLASH = True
 LIMAS_CACHE_ENABLED = True
 
+# Record the latency, payload sizes, and errors of each limas RPC call. 
+# Percentiles are over the last LIMAS_RPC_STATS_WINDOW calls per method, and
+# calls taking LIMAS_SLOW_CALL_THRESHOLD seconds or more are written to 
+# SLOW_CALL_LOG_FILE, with the last LIMAS_SLOW_CALL_HISTORY shown on sysinfo
+LIMAS_RPC_STATS_ENABLED = True
+LIMAS_RPC_STATS_WINDOW = 1000
+LIMAS_SLOW_CALL_THRESHOLD = 2.0
+LIMAS_SLOW_CALL_HISTORY = 50
+
+# Reuse HTTP connections to limas across requests. At most 
+# LIMAS_CONNECTION_POOL_SIZE connections per process are used at once, and 
+# idle connections are closed after LIMAS_CONNECTION_POOL_IDLE_TIMEOUT 
+# seconds (keep this below the keep-alive timeout of the limas server). 
+# LIMAS_CONNECTION_TIMEOUT is the socket timeout in seconds (None to wait
+# indefinitely).
+LIMAS_CONNECTION_POOL_ENABLED = True
+LIMAS_CONNECTION_POOL_SIZE = 20
+LIMAS_CONNECTION_POOL_IDLE_TIMEOUT = 15
+LIMAS_CONNECTION_TIMEOUT = None
+
+# Make independent limas RPCs concurrently, using greenlets ('gevent'), a 
+# pool of LIMAS_FAN_OUT_THREADS threads ('threads'), or not at all (None). 
+# The calls together must complete within LIMAS_FAN_OUT_TIMEOUT seconds. 
+# Use 'gevent' when running under services/gevent-server.py.
+LIMAS_FAN_OUT = 'threads'
+LIMAS_FAN_OUT_THREADS = 10
+LIMAS_FAN_OUT_TIMEOUT = 30
+
+# Send related limas RPCs together as a JSON-RPC 2.0 batch. Turned off for 
+# the rest of the process if limas rejects a batch.
+LIMAS_RPC_BATCHES = True
+
+# Maximum number of greenlets running AsyncLimasService calls per process
+LIMAS_ASYNC_CONCURRENCY = 1000
+
+# Minimum number of seconds between checks for limas index updates
+LIMAS_GENERATION_POLL_INTERVAL = 30
+
+# Processes missing on the same cache entry wait (polling every 
+# LIMAS_CACHE_LEASE_POLL_INTERVAL seconds) for the first one to fetch it, 
+# for at most LIMAS_CACHE_LEASE_TIMEOUT seconds
+LIMAS_CACHE_LEASE_TIMEOUT = 30
+LIMAS_CACHE_LEASE_POLL_INTERVAL = 0.1
+
+# Instead of clearing the caches when the limas index is updated, serve the 
+# outdated entries while they are refreshed in the background, for at most 
+# LIMAS_CACHE_MAX_STALENESS seconds after the update
+LIMAS_CACHE_STALE_WHILE_REVALIDATE = False
+LIMAS_CACHE_MAX_STALENESS = 3600
+
+# Size limits for the mongodb limas caches. The least recently used entries 
+# are evicted when a cache holds more than 'documents' entries or 'bytes' of 
+# data, and entries unused for 'ttl' seconds are expired by mongodb. Limits 
+# set to None are not enforced.
+LIMAS_CACHE_DEFAULT_LIMITS = {
+    'documents': 100000,
+    'bytes': 1024 * 1024 * 1024,
+    'ttl': None,
+}
+LIMAS_CACHE_LIMITS = {
+    'results': {'documents': 10000, 'bytes': 512 * 1024 * 1024},
+    'suggestions': {'documents': 10000},
+    'transcripts': {'bytes': 256 * 1024 * 1024},
+    'facetracks': {'bytes': 256 * 1024 * 1024},
+}
+
+# Minimum number of seconds between updates of the last access time of a 
+# cached entry
+LIMAS_CACHE_ACCESS_RESOLUTION = 600
+
+# Write the videos and segments of a new search result to their caches in 
+# the background, after the results have been returned
+LIMAS_CACHE_DEFER_SEARCH_WRITES = True
+
+# Number of seconds between writes of per process cache metrics to mongodb
+LIMAS_CACHE_METRICS_FLUSH_INTERVAL = 60
+
+# Optional per-process cache in front of the mongodb limas caches. Entries 
+# expire after LIMAS_LOCAL_CACHE_TTL seconds unless overridden per cache.
+LIMAS_LOCAL_CACHE_ENABLED = False
+LIMAS_LOCAL_CACHE_MAX_ENTRIES = 10000
+LIMAS_LOCAL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+LIMAS_LOCAL_CACHE_TTL = 300
+LIMAS_LOCAL_CACHE_TTLS = {
+    'collectionstats': 3600,
+    'keyframes': 3600,
+    'results': 600,
+}
+
 LIMAS_STATS = {
     'entities':100, 
     'contributors':100, 
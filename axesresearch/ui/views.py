@@ -171,6 +171,8 @@ def download_metadata(request):
     
     def lookup_asset_metadata(uri):
         asset = Limas().lookup_asset(uri)
+        if asset is None:
+            raise Http404
         return asset['video']['metadata']
         
     def encode_metadata_json(metadata):
@@ -71,6 +71,8 @@ install_dependency supervisor
 install_dependency celery
 install_dependency django-celery
 install_dependency Pillow
+install_dependency numpy
+install_dependency scipy
 
 #
 # Create folders for log files and database
@@ -38,9 +38,16 @@ def setup_app(debug):
         os.environ['DJANGO_SETTINGS_MODULE'] = 'axesresearch.settings.production'
     
 def start_server(port, host=''):
+    import gevent, signal
     from gevent.wsgi import WSGIServer
     from django.core.handlers.wsgi import WSGIHandler
-    WSGIServer((host, port), WSGIHandler()).serve_forever()
+    server = WSGIServer((host, port), WSGIHandler())
+    
+    # Supervisord stops the server with SIGTERM. Stop serving and return, 
+    # so the interpreter exits normally and the atexit hooks flush the 
+    # buffered view counts and cache metrics.
+    gevent.signal(signal.SIGTERM, server.stop)
+    server.serve_forever()
     
 def parse_args():
     import argparse